@@ -0,0 +1,307 @@
+"""PyTonk 性能基准测试
+
+用法: python benchmark.py [音符数量 ...] [--frames N] [--score-plays N] [--output results.json]
+
+对每个谱面规模测量逐帧热点函数的耗时（中位数/p99）与每次调用分配的内存，
+结果可保存为 JSON，便于比较不同版本。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+import contextlib
+
+# 无需显示设备
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+from main import (NoteSystem, AdaptiveRenderer, PyTonkGame, VirtualClock, ScoreDatabase,
+                  init_pygame, NOTE_TYPE_NAMES, SIM_RATE, VERSION)
+
+FRAME_MS = 16  # 约 60 FPS
+NOTES_PER_SECOND = 8  # 固定谱面密度，屏幕上的音符数量与谱面长度无关
+DRAW_STATES = ["main_menu", "song_select", "playing", "pause_menu", "results",
+               "achievements", "settings", "editor"]
+
+
+def build_note_system(note_count, seed=0):
+    """生成指定数量音符的长谱面"""
+    rng = random.Random(seed)
+    note_system = NoteSystem(AdaptiveRenderer())
+    duration = int(note_count / NOTES_PER_SECOND * 1000)
+    types = [rng.randrange(len(NOTE_TYPE_NAMES)) for _ in range(note_count)]
+    times = [rng.randint(0, duration) for _ in range(note_count)]
+    lanes = [rng.randint(0, 7) for _ in range(note_count)]
+    note_system.set_notes(types, times, lanes, [0] * note_count)
+    return note_system, duration
+
+
+def bench_chart_memory(note_count):
+    """比较列式音符表与旧版每音符一个字典的内存占用"""
+    note_system, _ = build_note_system(note_count)
+    notes = note_system.notes
+
+    tracemalloc.start()
+    legacy = [{
+        'type': NOTE_TYPE_NAMES[notes.type[i]],
+        'time': int(notes.time[i]),
+        'lane': int(notes.lane[i]),
+        'duration': int(notes.duration[i]),
+        'state': 'inactive',
+        'progress': 0,
+        'hit_time': 0,
+        'effect': None
+    } for i in range(note_count)]
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del legacy
+
+    return {'notes': note_count, 'store_bytes': notes.nbytes, 'dict_bytes': legacy_bytes}
+
+
+def percentile(samples, fraction):
+    """取样本的百分位数（最近秩）"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(func, calls, alloc_calls=None):
+    """测量 func 每次调用的耗时，并另外用 tracemalloc 统计每次调用分配的峰值内存
+
+    func 接收调用序号 i，便于每次调用推进时间。
+    """
+    samples = []
+    for i in range(calls):
+        start = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    # tracemalloc 本身很慢，只在单独的少量调用中开启
+    alloc_calls = alloc_calls or min(calls, 50)
+    allocations = []
+    tracemalloc.start()
+    for i in range(calls, calls + alloc_calls):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func(i)
+        allocations.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    return {
+        'calls': calls,
+        'median_us': statistics.median(samples),
+        'p99_us': percentile(samples, 0.99),
+        'max_us': max(samples),
+        'alloc_bytes': statistics.mean(allocations),
+    }
+
+
+@contextlib.contextmanager
+def temporary_workdir():
+    """在临时目录中运行，游戏读写的进度、缓存和成绩库都不会落在当前目录"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            yield workdir
+        finally:
+            os.chdir(cwd)
+
+
+def build_game(note_count, seed=0):
+    """创建无显示的游戏实例，并载入指定数量音符的谱面，时间停在谱面中段"""
+    game = PyTonkGame(clock=VirtualClock(), headless=True)
+    game.screen = pygame.display.set_mode((1280, 720))
+    game.renderer.update(game.screen)
+
+    song = game.music_library.songs[0]
+    game.prepare_song(song, game.difficulty, seed)
+    game.note_system, duration = build_note_system(note_count, seed)
+    game.game_stats['total_notes'] = note_count
+    game.song_duration = duration
+    game.start_time = 0
+    game.game_state = "playing"
+    
+    # 歌曲时钟从虚拟时间 0 开始，直接跳到谱面中段；模拟步数与之对应，
+    # 之后 check_note_hit 推进模拟时不会从头补算
+    middle = duration // 2
+    game.song_clock.start(audio=False)
+    game.clock.time = float(middle)
+    game.simulate_frame(middle)
+    game.sim_step = middle * SIM_RATE // 1000
+    return game
+
+
+def bench_note_update(note_count, frames):
+    """NoteSystem.update（谱面中段，不击中任何音符）"""
+    note_system, duration = build_note_system(note_count)
+    start_time = duration // 2
+    note_system.update(start_time)  # 预热: 跳过谱面前半段
+    result = measure(lambda i: note_system.update(start_time + (i + 1) * FRAME_MS), frames)
+    result['active'] = len(note_system.active_notes)
+    return result
+
+
+def bench_check_note_hit(game, frames):
+    """check_note_hit: 在判定线附近随机点击（屏幕坐标，时间为系统时间）"""
+    rng = random.Random(1)
+    clicks = [(rng.uniform(290, 990), rng.uniform(420, 580)) for _ in range(256)]
+    now = game.clock.get_ticks()
+    return measure(lambda i: game.check_note_hit(*clicks[i % len(clicks)], now), frames)
+
+
+def bench_calculate_note_position(game, frames):
+    """calculate_note_position: 计算当前活动音符的位置"""
+    indices = game.note_system.active_notes
+    result = measure(lambda i: game.calculate_note_position(indices), frames)
+    result['active'] = len(indices)
+    return result
+
+
+def bench_draw(game, state, frames):
+    """单个 draw_* 方法（绘制到虚拟显示的屏幕表面）"""
+    method = getattr(game, f"draw_{state}")
+    previous = game.game_state
+    if state != "pause_menu":
+        game.game_state = state
+    try:
+        return measure(lambda i: method(), frames)
+    finally:
+        game.game_state = previous
+
+
+def bench_generate_song_notes(note_count, frames):
+    """generate_song_notes: 生成约 note_count 个音符的谱面"""
+    note_system = NoteSystem(AdaptiveRenderer())
+    song_duration = note_count * 1.5  # 难度 1.0 时每 1.5 秒一个音符
+    calls = max(3, min(frames, 200000 // note_count))
+    return measure(lambda i: note_system.generate_song_notes(song_duration, 1.0, seed=i), calls,
+                   alloc_calls=min(calls, 5))
+
+
+def bench_save_load(game, frames):
+    """save_level 与 load_progress（在临时目录中读写）"""
+    calls = max(3, min(frames, 200000 // max(1, len(game.note_system.notes))))
+    # load_progress 每次调用都会打印，测量时丢弃输出
+    with temporary_workdir(), open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        game.save_progress()
+        save = measure(lambda i: game.save_level(), calls, alloc_calls=min(calls, 5))
+        load = measure(lambda i: game.load_progress(), frames)
+    return save, load
+
+
+def bench_score_database(plays, frames):
+    """成绩库: 写入 plays 局成绩后查询排行榜、个人最佳和历史（每次都绕过查询缓存）"""
+    rng = random.Random(2)
+    songs = [f"song{i}" for i in range(1, 13)]
+    with tempfile.TemporaryDirectory() as workdir:
+        scores = ScoreDatabase(os.path.join(workdir, "scores.db"))
+        start = time.perf_counter()
+        for i in range(plays):
+            scores.add(rng.choice(songs), rng.choice(["简单", "中等", "困难"]), rng.randint(0, 1000000),
+                       rng.random(), "A", rng.randint(0, 500), f"2024-01-{i % 28 + 1:02} 12:{i % 60:02}:00")
+        add_seconds = time.perf_counter() - start
+        scores.wait()
+        write_seconds = time.perf_counter() - start
+        
+        def uncached(query):
+            def call(i):
+                scores.cache.clear()
+                query(songs[i % len(songs)])
+            return call
+        
+        results = {
+            'plays': plays,
+            'add_us': add_seconds / plays * 1e6,
+            'write_seconds': write_seconds,
+            'leaderboard': measure(uncached(lambda song: scores.leaderboard(song, "中等")), frames),
+            'personal_best': measure(uncached(lambda song: scores.personal_best(song, "中等")), frames),
+            'history': measure(uncached(lambda song: scores.history(song, "中等")), frames),
+            'recent': measure(uncached(lambda song: scores.recent()), frames),
+        }
+        scores.executor.shutdown()
+        scores.reader.close()
+    return results
+
+
+def run_suite(sizes, frames, score_plays):
+    """运行全部基准，返回可序列化为 JSON 的结果"""
+    results = {
+        'version': VERSION,
+        'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pygame': pygame.version.ver,
+        'frames': frames,
+        'sizes': {},
+    }
+    for note_count in sizes:
+        # 游戏实例在绘制时才按需写入资源缓存和成绩库，整个规模的测量都在临时目录中进行
+        with temporary_workdir():
+            game = build_game(note_count)
+            entry = {
+                'memory': bench_chart_memory(note_count),
+                'NoteSystem.update': bench_note_update(note_count, frames),
+                'check_note_hit': bench_check_note_hit(game, frames),
+                'calculate_note_position': bench_calculate_note_position(game, frames),
+                'generate_song_notes': bench_generate_song_notes(note_count, frames),
+            }
+            entry['save_level'], entry['load_progress'] = bench_save_load(game, frames)
+            for state in DRAW_STATES:
+                entry[f"draw_{state}"] = bench_draw(game, state, frames)
+            game.audio_loader.shutdown()
+        results['sizes'][str(note_count)] = entry
+    results['score_database'] = bench_score_database(score_plays, frames)
+    return results
+
+
+def print_results(results):
+    for size, entry in results['sizes'].items():
+        memory = entry['memory']
+        print(f"\n== {size} 音符 (内存 {memory['store_bytes'] / 1024:.0f} KB, "
+              f"旧版字典 {memory['dict_bytes'] / 1024:.0f} KB) ==")
+        print(f"{'函数':<26} {'中位数(us)':>12} {'p99(us)':>10} {'分配(B)':>10}")
+        for name, result in entry.items():
+            if name == 'memory':
+                continue
+            print(f"{name:<26} {result['median_us']:>12.1f} {result['p99_us']:>10.1f} "
+                  f"{result['alloc_bytes']:>10.0f}")
+    
+    scores = results['score_database']
+    print(f"\n== 成绩库 {scores['plays']} 局 (每局记录 {scores['add_us']:.1f} us, "
+          f"后台写入 {scores['write_seconds']:.2f} 秒) ==")
+    for name in ('leaderboard', 'personal_best', 'history', 'recent'):
+        result = scores[name]
+        print(f"{name:<26} {result['median_us']:>12.1f} {result['p99_us']:>10.1f} "
+              f"{result['alloc_bytes']:>10.0f}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="PyTonk 性能基准测试")
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 10000, 100000], help="谱面音符数量")
+    parser.add_argument("--frames", type=int, default=600, help="每项测量的调用次数")
+    parser.add_argument("--score-plays", type=int, default=200000, help="成绩库基准中写入的局数")
+    parser.add_argument("--output", default=None, help="保存 JSON 结果的文件")
+    args = parser.parse_args(argv)
+
+    init_pygame(headless=True)
+    results = run_suite(args.sizes, args.frames, args.score_plays)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\n结果已保存到 {args.output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,12 +4,37 @@ import sys
 import math
 import random
 import json
+import time
+import argparse
+import bisect
+import struct
+import zlib
+import wave
+import hashlib
+import io
+import sqlite3
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from collections import OrderedDict
 from pygame.locals import *
 from datetime import datetime
 
-# 初始化
-pygame.init()
-pygame.mixer.init()
+STARTUP_TIME = time.perf_counter()  # 模块导入完成的时间，用于统计启动耗时
+
+MIXER_BUFFER = 512  # 音频缓冲区大小（采样数），决定输出延迟
+
+def init_pygame(headless=False):
+    """初始化 pygame，headless 模式使用 SDL 的虚拟显示和音频驱动"""
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+    pygame.init()
+    try:
+        pygame.mixer.init(buffer=MIXER_BUFFER)
+    except pygame.error as e:
+        print(f"无法初始化音频: {e}")
 
 # 版本信息
 VERSION = "beta 0.3.0"
@@ -24,6 +49,42 @@ HIGHLIGHT = (255, 215, 0)
 ERROR_COLOR = (255, 50, 50)
 SUCCESS_COLOR = (50, 205, 50)
 
+# 音符皮肤样式
+SKIN_STYLES = {
+    'default': {'tint': 0.0, 'detail': (255, 255, 255), 'glow': False},
+    'neon': {'tint': 0.0, 'detail': (255, 255, 255), 'glow': True},
+    'pastel': {'tint': 0.45, 'detail': (90, 90, 120), 'glow': False}
+}
+
+# 静态界面使用保留模式渲染：只在切换或失效时重绘
+STATIC_SCREENS = ("main_menu", "song_select", "results", "achievements", "settings")
+IDLE_WAIT_MS = 250  # 静态界面没有事件时的最长等待时间
+SIM_RATE = 240  # 固定步长模拟频率（判定和音符状态）
+MAX_SIM_STEPS = 60  # 每帧最多追赶的模拟步数，卡顿更久时分摊到后续帧
+DEFAULT_FPS = 60  # 无法获取显示器刷新率时的渲染帧率
+INPUT_POLL_MS = 1000 / SIM_RATE  # 帧间等待时轮询点击事件的间隔（一个模拟步长）
+
+# 判定时间窗口（毫秒）
+ACTIVATION_WINDOW = 1500  # 音符提前出现的时间
+MISS_WINDOW = 300  # 超过该时间未击中即判定为错过
+LANE_COUNT = 8  # 轨道数量
+
+# 音符类型编码（与 NoteSystem.note_types 的顺序一致）
+NOTE_TYPE_NAMES = ['tap', 'hold', 'flick', 'drag', 'special']
+NOTE_SUBDIVISIONS = 2  # 谱面网格: 每拍分为几格（2 为八分音符）
+NOTE_TYPE_CODES = {name: code for code, name in enumerate(NOTE_TYPE_NAMES)}
+
+# 音符状态编码
+STATE_INACTIVE = 0
+STATE_ACTIVE = 1
+STATE_HIT = 2
+STATE_MISSED = 3
+NOTE_STATE_NAMES = ['inactive', 'active', 'hit', 'missed']
+
+# 击中效果编码
+EFFECT_NAMES = [None, 'perfect', 'good', 'ok']
+EFFECT_CODES = {name: code for code, name in enumerate(EFFECT_NAMES)}
+
 # 自适应渲染系统
 class AdaptiveRenderer:
     def __init__(self):
@@ -48,6 +109,10 @@ class AdaptiveRenderer:
         scaled_y = y * self.scale_factor + self.offset_y
         return scaled_x, scaled_y
     
+    def inverse_transform_pos(self, x, y):
+        """将屏幕坐标转换回基准分辨率坐标"""
+        return (x - self.offset_x) / self.scale_factor, (y - self.offset_y) / self.scale_factor
+    
     def transform_size(self, size):
         """转换尺寸到当前分辨率"""
         return size * self.scale_factor
@@ -61,11 +126,568 @@ class AdaptiveRenderer:
         scaled_h = h * self.scale_factor
         return (scaled_x, scaled_y, scaled_w, scaled_h)
 
+# 时钟系统
+class GameClock:
+    """真实时钟: 使用 pygame 的系统时间并限制帧率"""
+    def __init__(self):
+        self.clock = pygame.time.Clock()
+        self.frame_start = pygame.time.get_ticks()
+    
+    def get_ticks(self):
+        return pygame.time.get_ticks()
+    
+    def tick(self, fps, poll=None):
+        """等待到下一帧；poll 不为 None 时在等待期间每隔 INPUT_POLL_MS 调用一次"""
+        if poll is not None and fps:
+            deadline = self.frame_start + 1000.0 / fps
+            remaining = deadline - pygame.time.get_ticks()
+            while remaining > 0:
+                pygame.time.wait(max(1, int(min(remaining, INPUT_POLL_MS))))
+                poll()
+                remaining = deadline - pygame.time.get_ticks()
+        elapsed = self.clock.tick(fps)
+        self.frame_start = pygame.time.get_ticks()
+        return elapsed
+
+class VirtualClock:
+    """虚拟时钟: 每次 tick 前进固定的一帧时间，不等待，用于无显示加速运行"""
+    def __init__(self, start=0):
+        self.time = float(start)
+    
+    def get_ticks(self):
+        return int(self.time)
+    
+    def tick(self, fps, poll=None):
+        frame_time = 1000.0 / fps
+        self.time += frame_time
+        return int(frame_time)
+
+class SongClock:
+    """歌曲时钟（毫秒，从歌曲开始算起）
+    
+    以 mixer 报告的播放位置为准: get_pos 只在音频缓冲区提交时才前进，直接使用会逐帧抖动，
+    所以用系统时钟走时，每次播放位置更新时把误差的一小部分并入偏移量。
+    """
+    SMOOTHING = 0.1  # 每次修正误差的比例
+    MAX_ERROR = 200  # 误差超过该值（如音频卡顿、跳转）时直接对齐
+    
+    def __init__(self, clock):
+        self.clock = clock
+        self.start(audio=False)
+    
+    def start(self, audio=False):
+        """歌曲开始播放时调用，audio 表示是否有音乐可以同步"""
+        self.start_ticks = self.clock.get_ticks()
+        self.paused_at = None
+        self.paused_total = 0
+        self.audio = audio
+        self.latency = self.get_output_latency() if audio else 0.0
+        self.offset = 0.0
+        self.last_audio_pos = None
+        self.last_time = 0
+        self.drift_samples = 0
+        self.drift_sum = 0.0
+        self.drift_abs_sum = 0.0
+        self.drift_max = 0.0
+    
+    @staticmethod
+    def get_output_latency():
+        """音频缓冲区带来的输出延迟（毫秒）"""
+        settings = pygame.mixer.get_init()
+        if not settings:
+            return 0.0
+        return MIXER_BUFFER * 1000.0 / settings[0]
+    
+    @property
+    def paused(self):
+        return self.paused_at is not None
+    
+    def pause(self):
+        if self.paused:
+            return
+        self.paused_at = self.clock.get_ticks()
+        if self.audio:
+            pygame.mixer.music.pause()
+    
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused_total += self.clock.get_ticks() - self.paused_at
+        self.paused_at = None
+        self.last_audio_pos = None
+        if self.audio:
+            pygame.mixer.music.unpause()
+    
+    def at(self, ticks):
+        """把系统时间换算成歌曲时间（用于输入事件的时间戳）"""
+        if self.paused:
+            ticks = min(ticks, self.paused_at)
+        return int(ticks - self.start_ticks - self.paused_total + self.offset)
+    
+    def now(self):
+        """当前歌曲时间: 与音频位置同步，且不会倒退"""
+        ticks = self.clock.get_ticks()
+        if self.audio and not self.paused:
+            self.sync(ticks)
+        song_time = max(self.at(ticks), self.last_time)
+        self.last_time = song_time
+        return song_time
+    
+    def sync(self, ticks):
+        """读取 mixer 播放位置并修正偏移量"""
+        pos = pygame.mixer.music.get_pos()
+        if pos < 0:
+            # 音乐已结束，之后只用系统时钟
+            self.audio = False
+            return
+        if pos == self.last_audio_pos:
+            return
+        self.last_audio_pos = pos
+        
+        audio_time = pos - self.latency
+        error = audio_time - (ticks - self.start_ticks - self.paused_total + self.offset)
+        self.drift_samples += 1
+        self.drift_sum += error
+        self.drift_abs_sum += abs(error)
+        self.drift_max = max(self.drift_max, abs(error))
+        if abs(error) > self.MAX_ERROR:
+            self.offset += error
+        else:
+            self.offset += error * self.SMOOTHING
+    
+    def drift_stats(self):
+        """系统时钟相对音频位置的漂移统计（毫秒）"""
+        count = max(1, self.drift_samples)
+        return {
+            'samples': self.drift_samples,
+            'mean': self.drift_sum / count,
+            'mean_abs': self.drift_abs_sum / count,
+            'max_abs': self.drift_max,
+            'offset': self.offset,
+            'latency': self.latency,
+        }
+
+# 输入时间戳
+INPUT_EVENTS = (MOUSEBUTTONDOWN, FINGERDOWN)
+
+class InputTimestamps:
+    """给点击事件标上发生时刻（系统时间），判定使用该时刻而不是事件被处理的时刻
+    
+    SDL 事件自带 timestamp 时直接使用（只在真实时钟下，两者同为 SDL_GetTicks）；否则在帧间
+    等待时按模拟步长轮询事件队列，以取出的时刻为准，帧内到达的事件以取出时刻为准。
+    同时记录每个点击从发生到被处理的延迟，即判定中扣除的延迟。
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.native = isinstance(clock, GameClock)
+        self.pending = []  # 等待期间取出、下一帧处理的事件
+        self.delays = []  # 本局每次点击的处理延迟（毫秒）
+    
+    def stamp(self, events, now):
+        for event in events:
+            if event.type in INPUT_EVENTS and not (self.native and hasattr(event, "timestamp")):
+                event.timestamp = now
+    
+    def poll(self):
+        """帧间等待时调用: 取出点击事件并记下时刻"""
+        events = pygame.event.get(INPUT_EVENTS)
+        if events:
+            self.stamp(events, self.clock.get_ticks())
+            self.pending.extend(events)
+    
+    def collect(self, events):
+        """本帧要处理的事件: 先是等待期间取出的点击，再是本帧取出的事件"""
+        self.stamp(events, self.clock.get_ticks())
+        if self.pending:
+            events = self.pending + events
+            self.pending = []
+        return events
+    
+    def record(self, event):
+        """处理一个点击事件，返回它的时间戳（没有时返回 None）"""
+        timestamp = getattr(event, "timestamp", None)
+        if timestamp is not None:
+            self.delays.append(self.clock.get_ticks() - timestamp)
+        return timestamp
+    
+    def reset(self):
+        self.pending = []
+        self.delays = []
+    
+    def delay_stats(self):
+        """处理延迟的统计（毫秒），没有记录时全部为 0"""
+        if not self.delays:
+            return {'count': 0, 'mean': 0.0, 'p95': 0.0, 'max': 0.0}
+        delays = np.array(self.delays, dtype=float)
+        return {
+            'count': len(delays),
+            'mean': float(delays.mean()),
+            'p95': float(np.percentile(delays, 95)),
+            'max': float(delays.max()),
+        }
+
+# 列式音符存储
+class NoteStore:
+    """每个字段一个 NumPy 数组的音符表（按时间排序）"""
+    COLUMNS = (
+        ('time', np.int32),
+        ('lane', np.int8),
+        ('duration', np.int32),
+        ('type', np.int8),
+        ('state', np.int8),
+        ('progress', np.float32),
+        ('hit_time', np.int32),
+        ('effect', np.int8),
+    )
+    
+    def __init__(self, size=0):
+        # np.zeros 由操作系统按需分配内存页，未用到的部分不占物理内存
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, np.zeros(size, dtype))
+        self.loaded = size  # 前 loaded 个音符的谱面字段已就绪
+        self.source = None  # 尚未读完的谱面文件
+    
+    def __len__(self):
+        return len(self.time)
+    
+    @classmethod
+    def from_chart(cls, chart):
+        """由谱面文件创建，谱面字段在 load_until 时按需读入"""
+        store = cls(len(chart))
+        store.loaded = 0
+        store.source = chart if len(chart) else None
+        return store
+    
+    def load_until(self, time):
+        """读入时间不晚于 time 的音符（每次至少读一块，减少小块读取）"""
+        chart = self.source
+        if chart is None:
+            return
+        start = self.loaded
+        stop = chart.find(time)
+        if stop <= start:
+            return
+        stop = max(stop, min(start + CHART_LOAD_BLOCK, len(chart)))
+        records = chart.records[start:stop]
+        for name in ('time', 'lane', 'duration', 'type'):
+            getattr(self, name)[start:stop] = records[name]
+        self.loaded = stop
+        if stop == len(chart):
+            self.source = None  # 已全部读入，释放文件映射
+    
+    def load_all(self):
+        self.load_until(np.iinfo(np.int32).max)
+    
+    @classmethod
+    def from_arrays(cls, times, lanes, durations, types):
+        """由谱面数据创建，并按时间稳定排序"""
+        order = np.argsort(np.asarray(times), kind='stable')
+        store = cls(len(order))
+        store.time[:] = np.asarray(times)[order]
+        store.lane[:] = np.asarray(lanes)[order]
+        store.duration[:] = np.asarray(durations)[order]
+        store.type[:] = np.asarray(types)[order]
+        return store
+    
+    def insert(self, index, time, lane, duration, note_type):
+        """在指定位置插入一个音符（编辑器使用）"""
+        self.load_all()
+        values = {'time': time, 'lane': lane, 'duration': duration, 'type': note_type}
+        for name, dtype in self.COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, np.insert(column, index, values.get(name, 0)).astype(dtype, copy=False))
+    
+    def with_fresh_state(self):
+        """共享谱面字段（只读），重新分配游戏状态字段，用于从缓存开始新的一局"""
+        self.load_all()
+        store = NoteStore()
+        for name in ('time', 'lane', 'duration', 'type'):
+            setattr(store, name, getattr(self, name))
+        for name, dtype in self.COLUMNS:
+            if name not in ('time', 'lane', 'duration', 'type'):
+                setattr(store, name, np.zeros(len(self), dtype))
+        store.loaded = len(self)
+        return store
+    
+    def take(self, indices):
+        """复制指定音符为新的音符表"""
+        store = NoteStore()
+        for name, _ in self.COLUMNS:
+            setattr(store, name, getattr(self, name)[indices])
+        return store
+    
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name, _ in self.COLUMNS)
+    
+    def checksum(self):
+        """谱面内容的摘要（只包含谱面字段，不含游戏中的状态）"""
+        if self.source is not None:
+            return self.source.checksum()
+        digest = hashlib.blake2b(digest_size=8)
+        for name in ('time', 'lane', 'duration', 'type'):
+            digest.update(getattr(self, name).tobytes())
+        return digest.digest()
+
+# 二进制谱面文件
+CHART_MAGIC = b"PTCH"
+CHART_VERSION = 1
+# 魔数, 版本, 记录长度, 音符数, 索引间隔(毫秒), 索引项数, 元数据长度
+CHART_HEADER = struct.Struct('<4sHHIIII')
+CHART_RECORD = np.dtype([('time', '<i4'), ('duration', '<i4'), ('lane', 'i1'), ('type', 'i1')])
+CHART_INDEX_INTERVAL = 1000  # 稀疏时间索引: 每秒记录第一个音符的下标
+CHART_LOAD_BLOCK = 256  # 每次至少读入的音符数
+CUSTOM_LEVEL_FILE = "custom_level.chart"
+
+class ChartFile:
+    """内存映射的二进制谱面
+    
+    文件结构: 文件头 | 元数据(JSON) | 稀疏时间索引(uint32) | 按时间排序的定长记录。
+    记录区按 16 字节对齐，打开时只读取文件头和索引，记录由操作系统按需换入。
+    """
+    def __init__(self, records, index, meta, interval=CHART_INDEX_INTERVAL):
+        self.records = records
+        self.index = index
+        self.meta = meta
+        self.interval = interval
+    
+    def __len__(self):
+        return len(self.records)
+    
+    @staticmethod
+    def layout(meta_length, index_count):
+        """记录区在文件中的偏移"""
+        offset = CHART_HEADER.size + meta_length + index_count * 4
+        return (offset + 15) // 16 * 16
+    
+    @classmethod
+    def save(cls, path, notes, meta):
+        """把音符表写成二进制谱面"""
+        notes.load_all()
+        records = np.zeros(len(notes), CHART_RECORD)
+        for name in ('time', 'lane', 'duration', 'type'):
+            records[name] = getattr(notes, name)
+        
+        last_time = int(notes.time[-1]) if len(notes) else 0
+        index_count = max(0, last_time) // CHART_INDEX_INTERVAL + 1
+        index = np.searchsorted(notes.time, np.arange(index_count) * CHART_INDEX_INTERVAL, side='left')
+        meta_bytes = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+        
+        header = CHART_HEADER.pack(CHART_MAGIC, CHART_VERSION, CHART_RECORD.itemsize, len(records),
+                                   CHART_INDEX_INTERVAL, index_count, len(meta_bytes))
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(meta_bytes)
+            f.write(index.astype('<u4').tobytes())
+            f.write(bytes(cls.layout(len(meta_bytes), index_count) - f.tell()))
+            f.write(records.tobytes())
+    
+    @classmethod
+    def open(cls, path):
+        """打开谱面文件（不读取音符记录）"""
+        with open(path, "rb") as f:
+            header = f.read(CHART_HEADER.size)
+            if len(header) < CHART_HEADER.size:
+                raise ValueError("谱面文件不完整")
+            magic, version, record_size, count, interval, index_count, meta_length = CHART_HEADER.unpack(header)
+            if magic != CHART_MAGIC or version != CHART_VERSION or record_size != CHART_RECORD.itemsize:
+                raise ValueError("不支持的谱面格式")
+            meta = json.loads(f.read(meta_length).decode("utf-8"))
+            index = np.frombuffer(f.read(index_count * 4), '<u4').astype(np.intp)
+        
+        offset = cls.layout(meta_length, index_count)
+        if count:
+            records = np.memmap(path, CHART_RECORD, mode='r', offset=offset, shape=(count,))
+        else:
+            records = np.zeros(0, CHART_RECORD)
+        return cls(records, index, meta, interval)
+    
+    def find(self, time):
+        """第一个时间晚于 time 的记录下标（只在索引所指的一小段内二分查找）"""
+        if time < 0 or len(self.records) == 0:
+            return 0
+        block = time // self.interval
+        if block >= len(self.index):
+            lo = int(self.index[-1]) if len(self.index) else 0
+            hi = len(self.records)
+        else:
+            lo = int(self.index[block])
+            hi = int(self.index[block + 1]) if block + 1 < len(self.index) else len(self.records)
+        return lo + int(np.searchsorted(self.records['time'][lo:hi], time, side='right'))
+    
+    def checksum(self, chunk=1 << 16):
+        """与 NoteStore.checksum 相同的摘要，分块计算，不整体读入"""
+        digest = hashlib.blake2b(digest_size=8)
+        columns = (('time', np.int32), ('lane', np.int8), ('duration', np.int32), ('type', np.int8))
+        for name, dtype in columns:
+            for start in range(0, len(self.records), chunk):
+                digest.update(self.records[name][start:start + chunk].astype(dtype).tobytes())
+        return digest.digest()
+
+# 编译谱面缓存
+GENERATOR_VERSION = 2  # 谱面生成算法变化时递增，旧缓存自动失效
+CHART_CACHE_DIR = "chart_cache"
+
+def chart_seed(song_id, difficulty):
+    """每首歌每个难度固定的默认种子，同一谱面在不同会话中保持一致"""
+    digest = hashlib.blake2b(f"{song_id}/{difficulty}".encode("utf-8"), digest_size=4).digest()
+    return int.from_bytes(digest, "little")
+
+class ChartCache:
+    """按 (歌曲, 难度, 生成器版本, 种子) 缓存编译好的谱面: 内存 LRU + 磁盘谱面文件
+    
+    内存和磁盘都按字节数限制大小，超出时淘汰最久未用的谱面。
+    """
+    def __init__(self, directory=CHART_CACHE_DIR, memory_limit=32 << 20, disk_limit=64 << 20):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.charts = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(song_id, difficulty, seed):
+        return (song_id, difficulty, GENERATOR_VERSION, seed)
+    
+    def path(self, key):
+        name = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).hexdigest()
+        return os.path.join(self.directory, f"{key[0]}-{name}.chart")
+    
+    def get(self, key):
+        """返回缓存的谱面（只含谱面字段），没有时返回 None"""
+        notes = self.charts.get(key)
+        if notes is not None:
+            self.charts.move_to_end(key)
+            self.hits += 1
+            return notes
+        
+        notes = self.load(key)
+        if notes is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self.remember(key, notes)
+        return notes
+    
+    def put(self, key, notes):
+        """缓存新编译的谱面，并写入磁盘"""
+        notes = notes.with_fresh_state()
+        self.remember(key, notes)
+        self.store(key, notes)
+    
+    def remember(self, key, notes):
+        if key in self.charts:
+            self.memory_bytes -= self.charts.pop(key).nbytes
+        self.charts[key] = notes
+        self.memory_bytes += notes.nbytes
+        while self.memory_bytes > self.memory_limit and len(self.charts) > 1:
+            _, evicted = self.charts.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+    
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            chart = ChartFile.open(path)
+            if chart.meta.get("key") != list(key):
+                return None
+            notes = NoteStore.from_chart(chart)
+            notes.load_all()
+            os.utime(path)  # 修改时间作为最近使用时间，供淘汰使用
+            return notes
+        except Exception as e:
+            print(f"读取谱面缓存错误: {e}")
+            return None
+    
+    def store(self, key, notes):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            ChartFile.save(self.path(key), notes, {"key": list(key)})
+            self.evict_disk()
+        except Exception as e:
+            print(f"写入谱面缓存错误: {e}")
+    
+    def evict_disk(self):
+        """磁盘缓存超过上限时删除最久未用的文件"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".chart"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_limit:
+                break
+            os.remove(path)
+            total -= size
+
+# 击中检测索引
+class HitTestIndex:
+    """按轨道分桶的活动音符索引，点击只检查附近轨道、判定时间窗内的音符"""
+    def __init__(self):
+        self.version = None
+        self.lane_notes = [np.zeros(0, np.intp)] * LANE_COUNT  # 每条轨道的音符下标（按时间排序）
+        self.lane_times = [np.zeros(0, np.int32)] * LANE_COUNT
+    
+    def rebuild(self, note_system):
+        """活动窗口变化后重建分桶（每帧最多一次，与点击次数无关）"""
+        active = note_system.active_notes
+        lanes = note_system.notes.lane[active]
+        order = np.argsort(lanes, kind='stable')
+        bounds = np.searchsorted(lanes[order], np.arange(LANE_COUNT + 1))
+        for lane in range(LANE_COUNT):
+            bucket = active[order[bounds[lane]:bounds[lane + 1]]]
+            self.lane_notes[lane] = bucket
+            self.lane_times[lane] = note_system.notes.time[bucket]
+        self.version = note_system.schedule_version
+    
+    def query(self, note_system, judgment_line, x, y, threshold):
+        """返回可能被 (x, y) 击中的活动音符下标（按时间排序）"""
+        if self.version != note_system.schedule_version:
+            self.rebuild(note_system)
+        
+        # 候选轨道: 音符横坐标为 judgment_line.x + lane * 100 - 350
+        lane_pos = (x - judgment_line.x + 350) / 100
+        first_lane = max(0, math.ceil(lane_pos - threshold / 100))
+        last_lane = min(LANE_COUNT - 1, math.floor(lane_pos + threshold / 100))
+        if first_lane > last_lane:
+            return np.zeros(0, np.intp)
+        
+        # 纵坐标为 base_y + 200 * clip(progress)，换算成进度区间
+        base_y = judgment_line.y - 200
+        low = (y - threshold - base_y) / 200
+        high = (y + threshold - base_y) / 200
+        if high < 0 or low > 1:
+            return np.zeros(0, np.intp)
+        
+        # 进度 = (current_time - time) / 1000，换算成时间区间（含 1 毫秒余量）
+        current_time = note_system.current_time
+        earliest = -2**31 if high > 1 else math.floor(current_time - high * 1000) - 1
+        latest = 2**31 - 1 if low < 0 else math.ceil(current_time - low * 1000) + 1
+        earliest = np.int32(max(earliest, -2**31))
+        latest = np.int32(min(latest, 2**31 - 1))
+        
+        buckets = []
+        for lane in range(first_lane, last_lane + 1):
+            times = self.lane_times[lane]
+            start = np.searchsorted(times, earliest, side='left')
+            end = np.searchsorted(times, latest, side='right')
+            buckets.append(self.lane_notes[lane][start:end])
+        candidates = buckets[0] if len(buckets) == 1 else np.sort(np.concatenate(buckets))
+        
+        # 已击中的音符在下次重建前仍留在桶里，这里过滤掉
+        return candidates[note_system.notes.state[candidates] == STATE_ACTIVE]
+
 # 音符系统
 class NoteSystem:
     def __init__(self, renderer):
         self.renderer = renderer
-        self.notes = []
+        self.notes = NoteStore()
         self.note_types = {
             'tap': {'color': (0, 200, 255), 'size': 25, 'score': 100},
             'hold': {'color': (255, 150, 0), 'size': 30, 'score': 150},
@@ -73,81 +695,318 @@ class NoteSystem:
             'drag': {'color': (0, 255, 100), 'size': 26, 'score': 180},
             'special': {'color': (255, 215, 0), 'size': 35, 'score': 300}
         }
-        self.active_notes = []
+        
+        # 按类型编码查询的属性表
+        self.type_colors = np.array([self.note_types[name]['color'] for name in NOTE_TYPE_NAMES], np.uint8)
+        self.type_sizes = np.array([self.note_types[name]['size'] for name in NOTE_TYPE_NAMES], np.int16)
+        self.type_scores = np.array([self.note_types[name]['score'] for name in NOTE_TYPE_NAMES], np.int32)
+        
+        self.active_notes = np.zeros(0, np.intp)  # 活动音符的下标（按时间排序）
         self.missed_notes = 0
         self.combo = 0
         self.max_combo = 0
         self.score = 0
         
+        # 调度器状态: [miss_index, next_index) 是已激活且尚未到期的音符
+        self.next_index = 0  # 下一个待激活音符的下标
+        self.miss_index = 0  # 下一个待判定错过的音符下标
+        self.current_time = 0  # 上次 update 的时间
+        self.schedule_version = 0  # 活动窗口变化时递增
+        self.hit_index = HitTestIndex()
+    
     def add_note(self, note_type, time, lane, duration=0):
-        """添加多类型音符"""
+        """添加多类型音符（保持时间顺序），返回音符下标"""
         if note_type not in self.note_types:
             note_type = random.choice(list(self.note_types.keys()))
         
-        note = {
-            'type': note_type,
-            'time': time,
-            'lane': lane,
-            'duration': duration,
-            'state': 'inactive',  # inactive, active, hit, missed
-            'progress': 0,
-            'hit_time': 0,
-            'effect': None
-        }
+        self.notes.load_all()
+        index = int(np.searchsorted(self.notes.time, np.int32(time), side='right'))
+        self.notes.insert(index, time, lane, duration, NOTE_TYPE_CODES[note_type])
         
-        self.notes.append(note)
-        return note
+        # 插入到游标之前的音符已经在激活窗口内，直接激活
+        if index < self.miss_index:
+            self.miss_index += 1
+            self.next_index += 1
+            self.notes.state[index] = STATE_MISSED
+            self.missed_notes += 1
+        elif index < self.next_index:
+            self.next_index += 1
+            self.notes.state[index] = STATE_ACTIVE
+        self.schedule_version += 1
+        self.refresh_active()
+        return index
+    
+    def set_notes(self, types, times, lanes, durations):
+        """整体替换谱面（类型为编码数组）"""
+        self.use_notes(NoteStore.from_arrays(times, lanes, durations, types))
+    
+    def load_chart(self, chart):
+        """使用谱面文件，音符在进入激活窗口前才从文件读入"""
+        self.use_notes(NoteStore.from_chart(chart))
+    
+    def use_notes(self, notes):
+        """使用已排序的音符表，回到谱面开头"""
+        self.notes = notes
+        self.next_index = 0
+        self.miss_index = 0
+        self.schedule_version += 1
+        self.refresh_active()
     
-    def generate_song_notes(self, song_duration, difficulty=1.0):
-        """为歌曲生成音符"""
-        self.notes = []
-        note_count = int(song_duration * difficulty / 1.5)
+    def generate_song_notes(self, song_duration, difficulty=1.0, seed=None, bpm=120):
+        """为歌曲生成音符（song_duration 单位为秒，相同种子生成相同谱面）
         
-        for _ in range(note_count):
-            note_type = random.choice(list(self.note_types.keys()))
-            time = random.randint(2000, int(song_duration * 1000) - 2000)
-            lane = random.randint(0, 7)
-            duration = random.randint(300, 1000) if note_type in ['hold', 'drag'] else 0
-            
-            self.add_note(note_type, time, lane, duration)
+        音符对齐到由 BPM 得到的八分音符网格，同一轨道同一时刻最多一个音符，
+        长按音符不会延伸到同轨道的下一个音符。
+        """
+        rng = np.random.default_rng(seed)
+        step = 60000.0 / bpm / NOTE_SUBDIVISIONS
+        
+        # 网格: 开头和结尾各留 2 秒
+        first = math.ceil(2000 / step)
+        last = math.floor((song_duration * 1000 - 2000) / step)
+        slot_count = max(0, last - first + 1)
+        cell_count = slot_count * LANE_COUNT
+        note_count = min(int(song_duration * difficulty / 1.5), cell_count)
+        
+        # 不重复地选取 (网格位置, 轨道)，避免同一轨道同一时刻出现多个音符
+        cells = np.sort(rng.choice(cell_count, note_count, replace=False))
+        slots = cells // LANE_COUNT + first
+        lanes = (cells % LANE_COUNT).astype(np.int8)
+        times = np.rint(slots * step).astype(np.int32)
+        types = rng.integers(0, len(NOTE_TYPE_NAMES), note_count).astype(np.int8)
+        
+        # 长按/拖动: 300-1000 毫秒，取整到网格，并截断到同轨道下一个音符之前
+        sustained = np.isin(types, [NOTE_TYPE_CODES['hold'], NOTE_TYPE_CODES['drag']])
+        lengths = np.maximum(1, np.rint(rng.integers(300, 1001, note_count) / step)).astype(np.int64)
+        by_lane = np.lexsort((slots, lanes))
+        gap = np.full(note_count, np.iinfo(np.int64).max)
+        same_lane = lanes[by_lane[1:]] == lanes[by_lane[:-1]]
+        gap[by_lane[:-1][same_lane]] = (slots[by_lane[1:]] - slots[by_lane[:-1]])[same_lane] - 1
+        lengths = np.where(sustained, np.minimum(lengths, gap), 0)
         
-        # 按时间排序
-        self.notes.sort(key=lambda x: x['time'])
+        # 放不下的长按音符改为点击
+        types[sustained & (lengths == 0)] = NOTE_TYPE_CODES['tap']
+        durations = np.rint(lengths * step).astype(np.int32)
+        
+        self.set_notes(types, times, lanes, durations)
+    
+    def refresh_active(self):
+        """重新计算活动音符下标"""
+        lo, hi = self.miss_index, self.next_index
+        self.active_notes = lo + np.flatnonzero(self.notes.state[lo:hi] == STATE_ACTIVE)
+    
+    def snapshot(self):
+        """保存运行状态（谱面字段不变，不需要复制）"""
+        notes = self.notes
+        passed = self.next_index  # 之后的音符都还未激活
+        lo = self.miss_index
+        return {
+            'state': notes.state[:passed].copy(),
+            'hit_time': notes.hit_time[:passed].copy(),
+            'effect': notes.effect[:passed].copy(),
+            'progress': notes.progress[lo:passed].copy(),
+            'next_index': passed,
+            'miss_index': lo,
+            'missed_notes': self.missed_notes,
+            'combo': self.combo,
+            'current_time': self.current_time
+        }
+    
+    def restore(self, snapshot):
+        """恢复 snapshot 保存的运行状态"""
+        notes = self.notes
+        passed = snapshot['next_index']
+        lo = snapshot['miss_index']
+        notes.state[:passed] = snapshot['state']
+        notes.state[passed:] = STATE_INACTIVE
+        notes.hit_time[:passed] = snapshot['hit_time']
+        notes.hit_time[passed:] = 0
+        notes.effect[:passed] = snapshot['effect']
+        notes.effect[passed:] = 0
+        notes.progress[lo:passed] = snapshot['progress']
+        self.next_index = passed
+        self.miss_index = lo
+        self.missed_notes = snapshot['missed_notes']
+        self.combo = snapshot['combo']
+        self.current_time = snapshot['current_time']
+        self.schedule_version += 1
+        self.refresh_active()
+    
+    def hit_note(self, index, hit_time, effect):
+        """标记音符被击中"""
+        self.notes.state[index] = STATE_HIT
+        self.notes.hit_time[index] = hit_time
+        self.notes.effect[index] = EFFECT_CODES[effect]
+        self.refresh_active()
     
     def update(self, current_time):
-        """更新音符状态"""
-        # 激活音符
-        for note in self.notes:
-            if note['state'] == 'inactive' and current_time >= note['time'] - 1500:
-                note['state'] = 'active'
-                self.active_notes.append(note)
-        
-        # 更新活动音符
-        for note in self.active_notes[:]:
-            note['progress'] = (current_time - note['time']) / 1000.0
-            
-            # 检查是否错过
-            if note['state'] == 'active' and current_time > note['time'] + 300:
-                note['state'] = 'missed'
-                self.missed_notes += 1
+        """更新音符状态（只处理状态发生变化的音符）"""
+        notes = self.notes
+        self.current_time = current_time
+        window = (self.miss_index, self.next_index)
+        
+        # 从谱面文件读入即将进入激活窗口的音符，之后只在已读入的部分查找
+        notes.load_until(current_time + ACTIVATION_WINDOW)
+        times = notes.time[:notes.loaded]
+        
+        # 激活音符: 游标只向前移动
+        # 查询值转换为与时间列相同的类型，避免 searchsorted 复制整列
+        hi = int(np.searchsorted(times, np.int32(current_time + ACTIVATION_WINDOW), side='right'))
+        if hi > self.next_index:
+            states = notes.state[self.next_index:hi]
+            states[states == STATE_INACTIVE] = STATE_ACTIVE
+            self.next_index = hi
+        
+        # 检查是否错过: 时间早于 current_time - MISS_WINDOW 的音符已到期
+        lo = min(int(np.searchsorted(times, np.int32(current_time - MISS_WINDOW), side='left')), self.next_index)
+        if lo > self.miss_index:
+            states = notes.state[self.miss_index:lo]
+            missed = states == STATE_ACTIVE
+            missed_count = int(np.count_nonzero(missed))
+            if missed_count:
+                states[missed] = STATE_MISSED
+                self.missed_notes += missed_count
                 self.combo = 0
-                self.active_notes.remove(note)
+            self.miss_index = lo
+        
+        # 更新活动音符进度
+        lo, hi = self.miss_index, self.next_index
+        notes.progress[lo:hi] = (current_time - notes.time[lo:hi]) / 1000.0
+        if (lo, hi) != window:
+            self.schedule_version += 1
+        self.refresh_active()
         
         # 更新连击奖励
         combo_bonus = 1.0 + (min(self.combo, 100) / 100.0)
         return combo_bonus
 
+# 文字渲染缓存
+class TextCache:
+    """按 (字体, 文本, 颜色, 抗锯齿) 缓存渲染好的文字表面，超出容量时淘汰最久未用的"""
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def render(self, font, text, antialias, color):
+        """与 font.render 参数相同，命中缓存时不再重新渲染"""
+        key = (font, text, tuple(color), antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        
+        self.misses += 1
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)
+        return surface
+    
+    def clear(self):
+        self.surfaces.clear()
+
+# 音符精灵图集
+class NoteAtlas:
+    """按皮肤和缩放比例预渲染的音符精灵，皮肤或分辨率变化时才重建"""
+    def __init__(self):
+        self.key = None
+        self.sprites = []  # 按类型编码索引
+        self.half_sizes = np.zeros(0, np.int32)  # 精灵中心到左上角的距离
+    
+    def get(self, note_system, skin, scale):
+        """获取当前皮肤和缩放比例的图集"""
+        key = (skin, scale)
+        if key != self.key:
+            self.build(note_system, skin, scale)
+            self.key = key
+        return self
+    
+    def build(self, note_system, skin, scale):
+        """预渲染每种音符类型"""
+        style = SKIN_STYLES.get(skin, SKIN_STYLES['default'])
+        self.sprites = []
+        half_sizes = []
+        for code, note_type in enumerate(NOTE_TYPE_NAMES):
+            radius = note_system.type_sizes[code] * scale
+            color = tuple(int(c + (255 - c) * style['tint']) for c in note_system.type_colors[code])
+            sprite = self.render_note(note_type, color, radius, style)
+            self.sprites.append(sprite)
+            half_sizes.append(sprite.get_width() // 2)
+        self.half_sizes = np.array(half_sizes, np.int32)
+    
+    def render_note(self, note_type, color, radius, style):
+        """绘制单个音符精灵"""
+        margin = radius * 0.4 if style['glow'] else 2
+        half = math.ceil(radius + margin)
+        sprite = pygame.Surface((half * 2, half * 2), pygame.SRCALPHA)
+        center = (half, half)
+        detail = style['detail']
+        
+        # 霓虹光晕（由外向内逐渐变亮）
+        if style['glow']:
+            for i in range(4, 0, -1):
+                glow_radius = radius + margin * i / 4
+                pygame.draw.circle(sprite, color + (150 - 30 * i,), center, glow_radius)
+        
+        # 音符主体
+        pygame.draw.circle(sprite, color, center, radius)
+        
+        # 音符类型指示
+        tx, ty = center
+        if note_type in ['hold', 'drag']:
+            inner_radius = radius * 0.6
+            pygame.draw.circle(sprite, detail, center, inner_radius, 2)
+        if note_type == 'flick':
+            # 绘制箭头
+            arrow_size = radius * 0.8
+            pygame.draw.line(sprite, detail, (tx - arrow_size, ty), (tx + arrow_size, ty), 2)
+            pygame.draw.line(sprite, detail, (tx + arrow_size - 10, ty - 10), (tx + arrow_size, ty), 2)
+            pygame.draw.line(sprite, detail, (tx + arrow_size - 10, ty + 10), (tx + arrow_size, ty), 2)
+        if note_type == 'special':
+            # 绘制星形
+            star_points = []
+            for i in range(5):
+                angle = math.pi/2 + i * 2*math.pi/5
+                star_points.append((tx + radius * math.cos(angle), ty + radius * math.sin(angle)))
+                angle += math.pi/5
+                star_points.append((tx + radius * 0.5 * math.cos(angle), ty + radius * 0.5 * math.sin(angle)))
+            pygame.draw.polygon(sprite, detail, star_points, 2)
+        
+        if style['glow']:
+            pygame.draw.circle(sprite, (255, 255, 255), center, radius, 2)
+        
+        if pygame.display.get_surface() is not None:
+            sprite = sprite.convert_alpha()
+        return sprite
+
+# 音符位置缓存
+class NotePositions:
+    """一帧内所有活动音符的坐标（绘制与击中检测共用）"""
+    def __init__(self, key, indices, x, y, screen_x, screen_y):
+        self.key = key
+        self.indices = indices  # 音符下标（按时间排序）
+        self.x = x  # 基准分辨率坐标
+        self.y = y
+        self.screen_x = screen_x  # 屏幕坐标
+        self.screen_y = screen_y
+
 # 判定线系统
 class JudgmentLine:
-    def __init__(self, renderer):
+    def __init__(self, renderer, clock=None):
         self.renderer = renderer
+        self.clock = clock or GameClock()
         self.x = 640
         self.y = 500
         self.angle = 0
         self.speed = 0
         self.amplitude = 100
         self.movement_type = "sine"
-        self.last_update = pygame.time.get_ticks()
+        self.last_update = self.clock.get_ticks()
+        self.delta = 0.0
+        self.rng = random.Random()
         self.movement_patterns = {
             "sine": self.sine_movement,
             "circle": self.circle_movement,
@@ -155,10 +1014,29 @@ class JudgmentLine:
             "zigzag": self.zigzag_movement
         }
     
-    def update(self):
+    def reset(self, seed=None):
+        """回到初始位置并重置随机运动的种子（回放时可以重现相同的运动）"""
+        self.x = 640
+        self.y = 500
+        self.angle = 0
+        self.last_update = None
+        self.delta = 0.0
+        self.rng = random.Random(seed)
+    
+    def snapshot(self):
+        return (self.x, self.y, self.angle, self.last_update, self.delta, self.rng.getstate())
+    
+    def restore(self, snapshot):
+        self.x, self.y, self.angle, self.last_update, self.delta, rng_state = snapshot
+        self.rng.setstate(rng_state)
+    
+    def update(self, current_time=None):
         """更新判定线位置（实现乱飞效果）"""
-        current_time = pygame.time.get_ticks()
-        delta = (current_time - self.last_update) / 1000.0
+        if current_time is None:
+            current_time = self.clock.get_ticks()
+        if self.last_update is None:
+            self.last_update = current_time
+        self.delta = (current_time - self.last_update) / 1000.0
         self.last_update = current_time
         
         # 应用当前运动模式
@@ -177,10 +1055,10 @@ class JudgmentLine:
         self.y = 500 + math.sin(time / 1200) * self.amplitude
     
     def random_movement(self, time):
-        """随机跳跃"""
-        if random.random() > 0.98:
-            self.x = random.randint(200, 1000)
-            self.y = random.randint(300, 600)
+        """随机跳跃（平均每秒 1.2 次，与更新频率无关）"""
+        if self.rng.random() < min(self.delta, 0.1) * 1.2:
+            self.x = self.rng.randint(200, 1000)
+            self.y = self.rng.randint(300, 600)
     
     def zigzag_movement(self, time):
         """锯齿运动"""
@@ -199,7 +1077,22 @@ class JudgmentLine:
         return rotated_x, rotated_y
 
 # 成就系统
+ACHIEVEMENT_TOAST_MS = 3000  # 游戏中解锁提示的显示时间
+
 class AchievementSystem:
+    """事件驱动的成就系统
+    
+    每条规则订阅一个事件，emit 只检查订阅了该事件的规则，成就解锁后规则即被移除，
+    每个事件的开销与成就总数无关。计数器跨局累计，由进度日志保存。
+    """
+    # 事件 -> 累加的计数器
+    EVENT_COUNTERS = {
+        'hit': 'hits',
+        'special_hit': 'special_hits',
+        'miss': 'misses',
+        'song_end': 'games_played',
+    }
+    
     def __init__(self):
         self.achievements = {
             'first_play': {'name': '初次游玩', 'desc': '完成第一次游戏', 'achieved': False, 'icon': '🎮'},
@@ -212,50 +1105,66 @@ class AchievementSystem:
             'song_complete': {'name': '歌曲达人', 'desc': '完成所有歌曲', 'achieved': False, 'icon': '🎵'}
         }
         self.unlocked = []
+        self.counters = {name: 0 for name in self.EVENT_COUNTERS.values()}
+        self.rules = {}  # 事件 -> [(成就 ID, 条件)]
+        
+        # 条件接收 (计数器, 事件数据)
+        self.add_rule('first_play', 'song_end', lambda counters, data: counters['games_played'] >= 1)
+        self.add_rule('full_combo', 'song_end', lambda counters, data:
+                      data['stats']['total_notes'] > 0 and data['stats']['max_combo'] == data['stats']['total_notes'])
+        self.add_rule('master', 'song_end', lambda counters, data:
+                      data['stats']['rank'] == 'S' and data['stats']['difficulty'] == '困难')
+        self.add_rule('no_miss', 'song_end', lambda counters, data: data['stats']['misses'] == 0)
+        self.add_rule('song_complete', 'song_end', lambda counters, data:
+                      data['completed_songs'] >= data['total_songs'])
+        self.add_rule('high_score', 'hit', lambda counters, data: data['score'] > 500000)
+        self.add_rule('long_combo', 'hit', lambda counters, data: data['combo'] >= 100)
+        self.add_rule('specialist', 'special_hit', lambda counters, data: counters['special_hits'] >= 50)
+    
+    def add_rule(self, achievement_id, event, condition):
+        self.rules.setdefault(event, []).append((achievement_id, condition))
     
     def unlock(self, achievement_id):
         if achievement_id in self.achievements and not self.achievements[achievement_id]['achieved']:
             self.achievements[achievement_id]['achieved'] = True
             self.unlocked.append(achievement_id)
+            # 已解锁的成就不再检查
+            for event, rules in self.rules.items():
+                self.rules[event] = [rule for rule in rules if rule[0] != achievement_id]
             return True
         return False
     
-    def check_achievements(self, game_stats):
-        """检查成就条件"""
-        if game_stats['games_played'] >= 1:
-            self.unlock('first_play')
-        if game_stats['max_combo'] >= 100:
-            self.unlock('long_combo')
-        if game_stats['max_combo'] == game_stats['total_notes'] and game_stats['total_notes'] > 0:
-            self.unlock('full_combo')
-        if game_stats['misses'] == 0 and game_stats['games_played'] > 0:
-            self.unlock('no_miss')
-        if game_stats['score'] > 500000:
-            self.unlock('high_score')
-        if game_stats['special_hits'] >= 50:
-            self.unlock('specialist')
-        if game_stats['rank'] == 'S' and game_stats['difficulty'] == '困难':
-            self.unlock('master')
-        if game_stats['completed_songs'] == 12:
-            self.unlock('song_complete')
+    def emit(self, event, amount=1, **data):
+        """处理一个事件，返回因此解锁的成就"""
+        counter = self.EVENT_COUNTERS.get(event)
+        if counter is not None:
+            self.counters[counter] += amount
+        
+        unlocked = []
+        for achievement_id, condition in self.rules.get(event, ()):
+            if condition(self.counters, data) and self.unlock(achievement_id):
+                unlocked.append(achievement_id)
+        return unlocked
 
 # 自动校准系统
 class AutoCalibration:
-    def __init__(self):
+    def __init__(self, clock=None):
+        self.clock = clock or GameClock()
         self.offset = 0
         self.samples = []
         self.calibration_complete = False
         self.calibration_step = 0
-        self.calibration_times = [pygame.time.get_ticks() + 2000, pygame.time.get_ticks() + 4000, 
-                                 pygame.time.get_ticks() + 6000, pygame.time.get_ticks() + 8000]
+        now = self.clock.get_ticks()
+        self.calibration_times = [now + 2000, now + 4000, now + 6000, now + 8000]
     
-    def start_calibration(self):
-        """开始校准过程"""
+    def start_calibration(self, now=None):
+        """开始校准过程（now 为节拍的起始时间，默认使用当前时间）"""
         self.samples = []
         self.calibration_step = 0
         self.calibration_complete = False
-        self.calibration_times = [pygame.time.get_ticks() + 2000, pygame.time.get_ticks() + 4000, 
-                                 pygame.time.get_ticks() + 6000, pygame.time.get_ticks() + 8000]
+        if now is None:
+            now = self.clock.get_ticks()
+        self.calibration_times = [now + 2000, now + 4000, now + 6000, now + 8000]
     
     def update_calibration(self, current_time):
         """更新校准状态"""
@@ -287,10 +1196,783 @@ class AutoCalibration:
         """根据校准结果调整时间"""
         return time - self.offset
 
+# 回放系统
+REPLAY_MAGIC = b"PTRP"
+REPLAY_VERSION = 2  # 2: 每帧对应一个固定模拟步
+REPLAY_HEADER = struct.Struct('<4sHI8sq')  # 魔数, 版本, 谱面种子, 谱面摘要, 开始时间
+
+def write_varint(buffer, value):
+    """写入 zigzag 变长整数"""
+    value = (value << 1) ^ (value >> 63)
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def read_varint(data, pos):
+    """读取 zigzag 变长整数，返回 (值, 新位置)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    return (value >> 1) ^ -(value & 1), pos
+
+def write_text(buffer, text):
+    data = text.encode('utf-8')
+    write_varint(buffer, len(data))
+    buffer.extend(data)
+
+def read_text(data, pos):
+    length, pos = read_varint(data, pos)
+    return bytes(data[pos:pos + length]).decode('utf-8'), pos + length
+
+class Replay:
+    """紧凑回放: 谱面种子 + 每帧时间 + 输入事件 + 判定线采样，可确定性地重建整局游戏"""
+    LINE_SAMPLE_INTERVAL = 1000  # 判定线采样间隔（毫秒），用于检查重建是否一致
+    
+    def __init__(self, song_id, difficulty, seed, chart_hash, start_time, movement_type="sine"):
+        self.song_id = song_id
+        self.difficulty = difficulty
+        self.seed = seed
+        self.chart_hash = chart_hash
+        self.start_time = start_time
+        self.movement_type = movement_type
+        self.frame_times = array('q')  # 每帧 update 的时间
+        self.inputs = []  # (帧序号, 时间, x, y)，在该帧 update 之前处理，坐标为基准分辨率
+        self.line_samples = []  # (帧序号, x, y, 角度)
+        self.last_sample_time = None
+        self.keyframes = []  # (帧序号, 状态)，录制或播放时保存，不写入回放数据
+    
+    def record_input(self, current_time, x, y):
+        """记录一次点击"""
+        self.inputs.append((len(self.frame_times), current_time, x, y))
+    
+    def record_frame(self, current_time, judgment_line):
+        """记录一帧，并按间隔采样判定线位置"""
+        self.frame_times.append(current_time)
+        if self.last_sample_time is None or current_time - self.last_sample_time >= self.LINE_SAMPLE_INTERVAL:
+            self.line_samples.append((len(self.frame_times) - 1, judgment_line.x, judgment_line.y, judgment_line.angle))
+            self.last_sample_time = current_time
+    
+    def keyframe_due(self, frame):
+        """第 frame 帧模拟之前是否应保存关键帧（录制和播放使用同一规则，第 0 帧由重置得到）"""
+        if frame == 0 or (self.keyframes and frame <= self.keyframes[-1][0]):
+            return False
+        elapsed = self.frame_start(frame) - self.start_time
+        return elapsed >= (len(self.keyframes) + 1) * ReplayPlayer.KEYFRAME_INTERVAL
+    
+    def frame_start(self, frame):
+        """第 frame 帧之前最近一次 update 的时间"""
+        return self.frame_times[frame - 1] if frame > 0 else self.start_time
+    
+    def encode(self):
+        """编码为压缩的二进制数据"""
+        body = bytearray()
+        write_text(body, self.song_id)
+        write_text(body, self.difficulty)
+        write_text(body, self.movement_type)
+        
+        # 帧时间: 与上一帧的差值
+        write_varint(body, len(self.frame_times))
+        previous = self.start_time
+        for frame_time in self.frame_times:
+            write_varint(body, frame_time - previous)
+            previous = frame_time
+        
+        # 输入事件: 帧序号差值 + 相对该帧开始的时间 + 坐标
+        write_varint(body, len(self.inputs))
+        previous_frame = 0
+        for frame, input_time, x, y in self.inputs:
+            write_varint(body, frame - previous_frame)
+            write_varint(body, input_time - self.frame_start(frame))
+            body.extend(struct.pack('<dd', x, y))
+            previous_frame = frame
+        
+        # 判定线采样
+        write_varint(body, len(self.line_samples))
+        previous_frame = 0
+        for frame, x, y, angle in self.line_samples:
+            write_varint(body, frame - previous_frame)
+            body.extend(struct.pack('<fff', x, y, angle))
+            previous_frame = frame
+        
+        header = REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.seed, self.chart_hash, self.start_time)
+        return header + zlib.compress(bytes(body), 9)
+    
+    @classmethod
+    def decode(cls, data):
+        """从二进制数据还原回放"""
+        if len(data) < REPLAY_HEADER.size:
+            raise ValueError("回放数据不完整")
+        magic, version, seed, chart_hash, start_time = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("不支持的回放格式")
+        
+        body = zlib.decompress(data[REPLAY_HEADER.size:])
+        song_id, pos = read_text(body, 0)
+        difficulty, pos = read_text(body, pos)
+        movement_type, pos = read_text(body, pos)
+        replay = cls(song_id, difficulty, seed, chart_hash, start_time, movement_type)
+        
+        count, pos = read_varint(body, pos)
+        previous = start_time
+        for _ in range(count):
+            delta, pos = read_varint(body, pos)
+            previous += delta
+            replay.frame_times.append(previous)
+        
+        count, pos = read_varint(body, pos)
+        frame = 0
+        for _ in range(count):
+            delta, pos = read_varint(body, pos)
+            frame += delta
+            offset, pos = read_varint(body, pos)
+            x, y = struct.unpack_from('<dd', body, pos)
+            pos += 16
+            replay.inputs.append((frame, replay.frame_start(frame) + offset, x, y))
+        
+        count, pos = read_varint(body, pos)
+        frame = 0
+        for _ in range(count):
+            delta, pos = read_varint(body, pos)
+            frame += delta
+            x, y, angle = struct.unpack_from('<fff', body, pos)
+            pos += 12
+            replay.line_samples.append((frame, x, y, angle))
+        return replay
+
+class ReplayPlayer:
+    """回放播放器: 0.25x-8x 变速播放和任意位置跳转
+    
+    关键帧按固定间隔保存在 Replay.keyframes 中: 录制时已经保存好，从二进制数据打开的回放
+    在播放或跳转向前模拟时补上。跳转只需从最近的关键帧向前模拟。
+    """
+    SPEEDS = [0.25, 0.5, 1.0, 2.0, 4.0, 8.0]
+    KEYFRAME_INTERVAL = 5000  # 关键帧间隔（回放时间，毫秒）
+    
+    def __init__(self, game, replay):
+        if not isinstance(replay, Replay):
+            replay = Replay.decode(replay)
+        self.game = game
+        self.replay = replay
+        self.input_frames = [frame for frame, _, _, _ in replay.inputs]
+        self.sample_frames = [frame for frame, _, _, _ in replay.line_samples]
+        self.position = 0  # 当前播放位置（毫秒，相对开始时间）
+        self.speed = 1.0
+        self.paused = False
+        self.last_tick = None
+        self.reset()
+    
+    @property
+    def duration(self):
+        if not self.replay.frame_times:
+            return 0
+        return self.replay.frame_times[-1] - self.replay.start_time
+    
+    @property
+    def keyframe_frames(self):
+        return [frame for frame, _ in self.replay.keyframes]
+    
+    def reset(self):
+        """重新生成谱面并回到第 0 帧"""
+        game = self.game
+        replay = self.replay
+        song = game.music_library.get_song_by_id(replay.song_id)
+        if song is None:
+            raise ValueError(f"找不到歌曲 {replay.song_id}")
+        game.prepare_song(song, replay.difficulty, replay.seed)
+        if game.note_system.notes.checksum() != replay.chart_hash:
+            raise ValueError("回放的谱面与生成结果不一致")
+        game.current_time = replay.start_time
+        game.judgment_line.movement_type = replay.movement_type
+        game.recording = False
+        game.replaying = True
+        
+        self.frame = 0  # 下一个要模拟的帧
+        self.next_input = 0
+        self.next_sample = 0
+        self.desync = 0  # 判定线采样不一致的次数
+    
+    @staticmethod
+    def capture(game, desync=0):
+        """保存游戏当前的模拟状态（录制时也调用）"""
+        return {
+            'notes': game.note_system.snapshot(),
+            'stats': dict(game.game_stats),
+            'line': game.judgment_line.snapshot(),
+            'current_time': game.current_time,
+            'desync': desync
+        }
+    
+    def restore(self, index):
+        """回到第 index 个关键帧"""
+        frame, keyframe = self.replay.keyframes[index]
+        game = self.game
+        game.note_system.restore(keyframe['notes'])
+        game.game_stats = dict(keyframe['stats'])
+        game.judgment_line.restore(keyframe['line'])
+        game.current_time = keyframe['current_time']
+        self.desync = keyframe['desync']
+        self.frame = frame
+        self.next_input = bisect.bisect_left(self.input_frames, self.frame)
+        self.next_sample = bisect.bisect_left(self.sample_frames, self.frame)
+    
+    def step(self):
+        """模拟下一帧: 先处理该帧之前的点击，再更新，与主循环顺序一致"""
+        replay = self.replay
+        game = self.game
+        frame = self.frame
+        
+        while self.next_input < len(replay.inputs) and replay.inputs[self.next_input][0] == frame:
+            _, input_time, x, y = replay.inputs[self.next_input]
+            game.judge_tap(x, y, input_time)
+            self.next_input += 1
+        
+        game.simulate_frame(replay.frame_times[frame])
+        
+        while self.next_sample < len(replay.line_samples) and replay.line_samples[self.next_sample][0] == frame:
+            _, x, y, angle = replay.line_samples[self.next_sample]
+            line = game.judgment_line
+            if abs(line.x - x) > 0.01 or abs(line.y - y) > 0.01 or abs(line.angle - angle) > 0.01:
+                self.desync += 1
+            self.next_sample += 1
+        self.frame += 1
+        
+        # 第一次模拟到这里时补上关键帧
+        if self.replay.keyframe_due(self.frame):
+            self.replay.keyframes.append((self.frame, self.capture(game, self.desync)))
+    
+    def seek(self, position):
+        """跳转到指定位置（毫秒）"""
+        position = min(max(position, 0), self.duration)
+        self.position = position
+        target = bisect.bisect_right(self.replay.frame_times, self.replay.start_time + int(position))
+        
+        # 目标在当前位置之后、且中间没有更近的关键帧时直接向前模拟
+        index = bisect.bisect_right(self.keyframe_frames, target) - 1
+        if index >= 0 and not (self.keyframe_frames[index] <= self.frame <= target):
+            self.restore(index)
+        elif target < self.frame:
+            self.reset()
+        
+        while self.frame < target:
+            self.step()
+    
+    def update(self, current_ticks):
+        """按播放速度推进"""
+        if self.last_tick is not None and not self.paused:
+            self.seek(self.position + (current_ticks - self.last_tick) * self.speed)
+        self.last_tick = current_ticks
+    
+    def change_speed(self, step):
+        """切换到更快(step > 0)或更慢(step < 0)的播放速度"""
+        index = self.SPEEDS.index(self.speed) + step
+        self.speed = self.SPEEDS[min(max(index, 0), len(self.SPEEDS) - 1)]
+    
+    def close(self):
+        """结束播放，游戏状态停在整局结束时"""
+        self.seek(self.duration)
+        self.game.replaying = False
+
+# 帧时间分析器
+PROFILE_FILE = "frame_profile.json"
+
+class FrameProfiler:
+    """按阶段统计每帧耗时（毫秒），保留最近 WINDOW 帧用于计算百分位数"""
+    PHASES = ("events", "update", "draw", "flip")
+    EVENTS, UPDATE, DRAW, FLIP = range(4)
+    WINDOW = 600
+    OVERLAY_RECT = (10, 580, 330, 130)  # 基准分辨率坐标
+    OVERLAY_REFRESH = 30  # 每隔多少帧刷新一次叠加层文字
+    
+    def __init__(self, fps=60):
+        self.enabled = False
+        self.target_ms = 1000.0 / fps
+        # 每行: 各阶段耗时 + 整帧间隔
+        self.samples = np.zeros((self.WINDOW, len(self.PHASES) + 1), dtype=np.float32)
+        self.current = [0.0] * len(self.PHASES)
+        self.reset()
+    
+    def reset(self):
+        self.count = 0
+        self.frames = 0
+        self.dropped = 0
+        self.worst_frame = None
+        self.frame_start = None
+        self.last_mark = 0.0
+        self.overlay = None
+        self.overlay_age = 0
+    
+    def toggle(self):
+        self.enabled = not self.enabled
+        # 暂停期间的间隔不计入统计
+        self.frame_start = None
+    
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.commit((now - self.frame_start) * 1000)
+        self.frame_start = now
+        self.last_mark = now
+        self.current = [0.0] * len(self.PHASES)
+    
+    def mark(self, phase):
+        """记录从上一个标记到现在的时间，计入 phase 阶段"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[phase] += (now - self.last_mark) * 1000
+        self.last_mark = now
+    
+    def commit(self, frame_ms):
+        row = self.samples[self.frames % self.WINDOW]
+        row[:-1] = self.current
+        row[-1] = frame_ms
+        self.frames += 1
+        self.count = min(self.count + 1, self.WINDOW)
+        if frame_ms > self.target_ms * 1.5:
+            self.dropped += 1
+        if self.worst_frame is None or frame_ms > self.worst_frame['frame']:
+            self.worst_frame = dict(zip(self.PHASES, self.current), frame=frame_ms)
+    
+    def stats(self):
+        """最近窗口内每个阶段的 p50/p95/p99"""
+        names = self.PHASES + ("frame",)
+        if self.count == 0:
+            return {}
+        percentiles = np.percentile(self.samples[:self.count], [50, 95, 99], axis=0)
+        return {name: {'p50': float(percentiles[0][i]), 'p95': float(percentiles[1][i]),
+                       'p99': float(percentiles[2][i])}
+                for i, name in enumerate(names)}
+    
+    def export(self, path=PROFILE_FILE):
+        """保存本次会话的统计结果"""
+        report = {
+            'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'target_ms': self.target_ms,
+            'frames': self.frames,
+            'dropped_frames': self.dropped,
+            'worst_frame': {key: float(value) for key, value in (self.worst_frame or {}).items()},
+            'recent': self.stats(),
+        }
+        try:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"帧时间统计已保存到 {path}")
+        except Exception as e:
+            print(f"保存帧时间统计错误: {e}")
+    
+    def draw(self, screen, renderer, font):
+        """绘制叠加层（文字每 OVERLAY_REFRESH 帧更新一次）"""
+        self.overlay_age -= 1
+        if self.overlay is None or self.overlay_age <= 0:
+            self.overlay = self.render_overlay(renderer, font)
+            self.overlay_age = self.OVERLAY_REFRESH
+        screen.blit(self.overlay, renderer.transform_pos(*self.OVERLAY_RECT[:2]))
+    
+    def render_overlay(self, renderer, font):
+        rect = renderer.transform_rect(self.OVERLAY_RECT)
+        surface = pygame.Surface((rect[2], rect[3]), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 180))
+        stats = self.stats()
+        lines = ["阶段      p50    p95    p99 (ms)"]
+        for name in self.PHASES + ("frame",):
+            if name in stats:
+                p = stats[name]
+                lines.append(f"{name:<8}{p['p50']:>6.1f} {p['p95']:>6.1f} {p['p99']:>6.1f}")
+        worst = self.worst_frame['frame'] if self.worst_frame else 0.0
+        lines.append(f"最差 {worst:.1f}ms  掉帧 {self.dropped}/{self.frames}")
+        line_height = rect[3] // len(lines)
+        for i, line in enumerate(lines):
+            text = font.render(line, True, TEXT_COLOR)
+            surface.blit(text, (5, i * line_height))
+        return surface
+
+# 自动输入（无显示运行时代替玩家）
+class AutoPlayInput:
+    """自动演奏: 音符到达判定时间时点击它的位置"""
+    def feed(self, game, current_time):
+        if game.game_state != "playing":
+            return
+        positions = game.calculate_note_positions()
+        notes = game.note_system.notes
+        due = (notes.time[positions.indices] <= current_time) & (notes.state[positions.indices] == STATE_ACTIVE)
+        for row in np.flatnonzero(due):
+            game.judge_tap(float(positions.x[row]), float(positions.y[row]), current_time)
+
+class ScriptedInput:
+    """按脚本点击: 每项为 [歌曲时间（毫秒）, x, y]，坐标为基准分辨率"""
+    def __init__(self, events):
+        self.events = sorted(events)
+        self.next_event = 0
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(json.load(f))
+    
+    def feed(self, game, current_time):
+        if game.game_state != "playing":
+            return
+        while self.next_event < len(self.events) and self.events[self.next_event][0] <= current_time:
+            event_time, x, y = self.events[self.next_event]
+            game.judge_tap(x, y, event_time)
+            self.next_event += 1
+
+# 音频元数据（只读取文件头，不解码音频）
+MUSIC_DIR = "Music"
+SONGS_PER_PAGE = 5  # 歌曲选择界面每页显示的歌曲数
+MUSIC_INDEX_FILE = "music_index.json"
+MUSIC_INDEX_VERSION = 2
+MUSIC_EXTENSIONS = (".mp3", ".ogg", ".wav")
+DEFAULT_BPM = 120
+
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],  # MPEG-1 Layer III
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],  # MPEG-2/2.5 Layer III
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def decode_id3_text(data):
+    """解码 ID3 文本帧（首字节为编码）"""
+    encoding = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}.get(data[0], "latin-1")
+    return data[1:].decode(encoding, errors="replace").strip("\x00").strip()
+
+def read_id3(head):
+    """解析 ID3v2.3/2.4 标签，返回 (标签字典, 标签总长度)"""
+    if len(head) < 10 or head[:3] != b"ID3":
+        return {}, 0
+    major, flags = head[3], head[5]
+    size = 10 + ((head[6] & 0x7f) << 21 | (head[7] & 0x7f) << 14 | (head[8] & 0x7f) << 7 | (head[9] & 0x7f))
+    if major == 4 and flags & 0x10:  # 标签尾
+        size += 10
+    tags = {}
+    if major not in (3, 4):
+        return tags, size
+    pos = 10
+    if flags & 0x40:  # 扩展头
+        ext = struct.unpack(">I", head[10:14])[0]
+        pos += ext if major == 3 else ext + 4
+    end = min(size, len(head))
+    while pos + 10 <= end:
+        frame_id = head[pos:pos + 4]
+        if frame_id[0] == 0:
+            break
+        raw = head[pos + 4:pos + 8]
+        if major == 4:
+            frame_size = (raw[0] & 0x7f) << 21 | (raw[1] & 0x7f) << 14 | (raw[2] & 0x7f) << 7 | (raw[3] & 0x7f)
+        else:
+            frame_size = struct.unpack(">I", raw)[0]
+        data = head[pos + 10:pos + 10 + frame_size]
+        if frame_id in (b"TIT2", b"TPE1", b"TBPM") and data:
+            tags[frame_id.decode()] = decode_id3_text(data)
+        pos += 10 + frame_size
+    return tags, size
+
+def find_mp3_frame(data, pos=0, verify=False):
+    """从 pos 开始查找 MPEG Layer III 帧头，返回 (位置, 版本, 码率序号, 采样率序号)，找不到时返回 None
+    
+    verify 为真时要求下一帧紧接在后面，避免把压缩数据中偶然出现的字节当作帧头（从文件中间查找时使用）。
+    """
+    while pos + 4 <= len(data):
+        if data[pos] == 0xff and data[pos + 1] & 0xe0 == 0xe0:
+            version = (data[pos + 1] >> 3) & 3
+            layer = (data[pos + 1] >> 1) & 3
+            bitrate_index = data[pos + 2] >> 4
+            rate_index = (data[pos + 2] >> 2) & 3
+            if version != 1 and layer == 1 and 0 < bitrate_index < 15 and rate_index < 3:
+                if not verify:
+                    return pos, version, bitrate_index, rate_index
+                mpeg1 = version == 3
+                bitrate = MP3_BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+                padding = (data[pos + 2] >> 1) & 1
+                following = pos + (144 if mpeg1 else 72) * bitrate // MP3_SAMPLE_RATES[version][rate_index] + padding
+                if find_mp3_frame(data[following:following + 4]) is not None:
+                    return pos, version, bitrate_index, rate_index
+        pos += 1
+    return None
+
+def read_mp3_duration(head, audio_size):
+    """根据第一个 MPEG Layer III 帧头计算时长（有 Xing/Info 头时使用帧数）
+    
+    head 从音频数据（ID3 标签之后）开始，audio_size 为从该位置到文件末尾的字节数。
+    """
+    frame = find_mp3_frame(head)
+    if frame is None:
+        return None
+    pos, version, bitrate_index, rate_index = frame
+    
+    mpeg1 = version == 3
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    bitrate = MP3_BITRATES[1 if mpeg1 else 2][bitrate_index]
+    samples_per_frame = 1152 if mpeg1 else 576
+    mono = head[pos + 3] >> 6 == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing = pos + 4 + side_info
+    if head[xing:xing + 4] in (b"Xing", b"Info") and len(head) >= xing + 12:
+        flags = struct.unpack(">I", head[xing + 4:xing + 8])[0]
+        if flags & 1:
+            frames = struct.unpack(">I", head[xing + 8:xing + 12])[0]
+            return frames * samples_per_frame / sample_rate
+    return (audio_size - pos) * 8 / (bitrate * 1000)
+
+def read_vorbis_comments(head):
+    """从 Ogg Vorbis 文件头读取采样率和注释"""
+    ident = head.find(b"\x01vorbis")
+    if ident < 0:
+        return None, {}
+    sample_rate = struct.unpack("<I", head[ident + 12:ident + 16])[0]
+    comments = {}
+    start = head.find(b"\x03vorbis")
+    if start >= 0:
+        try:
+            pos = start + 7
+            vendor_length = struct.unpack("<I", head[pos:pos + 4])[0]
+            pos += 4 + vendor_length
+            count = struct.unpack("<I", head[pos:pos + 4])[0]
+            pos += 4
+            for _ in range(count):
+                length = struct.unpack("<I", head[pos:pos + 4])[0]
+                key, _, value = head[pos + 4:pos + 4 + length].decode("utf-8", errors="replace").partition("=")
+                comments[key.upper()] = value.strip()
+                pos += 4 + length
+        except struct.error:
+            pass  # 注释跨越了读取范围
+    return sample_rate, comments
+
+def read_audio_metadata(path, head_size=1 << 16):
+    """读取音频文件的标题、艺术家、时长（秒）和 BPM，无法识别的字段为 None"""
+    meta = {"title": None, "artist": None, "duration": None, "bpm": None}
+    extension = os.path.splitext(path)[1].lower()
+    file_size = os.path.getsize(path)
+    
+    if extension == ".wav":
+        with wave.open(path, "rb") as w:
+            meta["duration"] = w.getnframes() / w.getframerate()
+        return meta
+    
+    with open(path, "rb") as f:
+        head = f.read(head_size)
+        if extension == ".mp3":
+            tags, tag_size = read_id3(head)
+            meta["title"] = tags.get("TIT2")
+            meta["artist"] = tags.get("TPE1")
+            meta["bpm"] = tags.get("TBPM")
+            # 帧头从标签之后开始查找（标签可能因内嵌封面而远大于 head_size）
+            audio = head
+            if tag_size:
+                f.seek(tag_size)
+                audio = f.read(head_size)
+            meta["duration"] = read_mp3_duration(audio, file_size - tag_size)
+        elif extension == ".ogg":
+            sample_rate, comments = read_vorbis_comments(head)
+            meta["title"] = comments.get("TITLE")
+            meta["artist"] = comments.get("ARTIST")
+            meta["bpm"] = comments.get("BPM")
+            # 最后一页的 granule position 即总采样数
+            f.seek(max(0, file_size - head_size))
+            tail = f.read()
+            last_page = tail.rfind(b"OggS")
+            if sample_rate and last_page >= 0 and last_page + 14 <= len(tail):
+                granule = struct.unpack("<q", tail[last_page + 6:last_page + 14])[0]
+                meta["duration"] = granule / sample_rate
+    
+    if meta["bpm"] is not None:
+        try:
+            meta["bpm"] = float(meta["bpm"])
+        except ValueError:
+            meta["bpm"] = None
+    return meta
+
+# 后台音频加载
+class AudioLoader:
+    """在线程池中预读歌曲文件、解码试听片段，主线程只做不阻塞的检查
+    
+    试听使用两个保留声道交替播放，切换歌曲时淡出旧片段、淡入新片段。
+    """
+    PREVIEW_START = 0.3  # 试听从歌曲的哪个位置开始（比例）
+    PREVIEW_LENGTH = 15000  # 试听片段长度（毫秒）
+    PREVIEW_FADE_MS = 500
+    PREVIEW_VOLUME = 0.6
+    MAX_FILES = SONGS_PER_PAGE  # 内存中保留的歌曲文件数（选曲界面一页）
+    
+    def __init__(self, max_workers=2):
+        self.enabled = pygame.mixer.get_init() is not None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.files = OrderedDict()  # 文件路径 -> Future(bytes)
+        self.previews = OrderedDict()  # 歌曲 ID -> Future(Sound)
+        self.wanted = None  # 希望试听的歌曲
+        self.wanted_song = None
+        self.playing = None  # 正在试听的歌曲
+        self.channels = []
+        self.channel_index = 0
+        if self.enabled:
+            pygame.mixer.set_reserved(2)
+            self.channels = [pygame.mixer.Channel(0), pygame.mixer.Channel(1)]
+    
+    def preload(self, song):
+        """后台读取歌曲文件"""
+        path = song["file"]
+        future = self.files.get(path)
+        if future is None:
+            future = self.executor.submit(self.read_file, path)
+            self.files[path] = future
+            while len(self.files) > self.MAX_FILES:
+                self.files.popitem(last=False)
+        else:
+            self.files.move_to_end(path)
+        return future
+    
+    def preload_page(self, songs):
+        """后台读取选曲界面当前页的全部歌曲，点击时即可从内存播放"""
+        for song in songs:
+            self.preload(song)
+    
+    @staticmethod
+    def read_file(path):
+        with open(path, "rb") as f:
+            return f.read()
+    
+    def request_preview(self, song):
+        """切换试听歌曲（解码完成后在 update 中开始播放）"""
+        if not self.enabled or self.wanted == song["id"]:
+            return
+        self.wanted = song["id"]
+        self.wanted_song = song
+        # 取消被替换的试听解码（正在解码的会在完成后丢弃），
+        # 已放弃解码（结果为 None）的也要移除，否则再次悬停时不会重新提交
+        for song_id, future in list(self.previews.items()):
+            if song_id == self.wanted:
+                continue
+            if not future.done():
+                future.cancel()
+                del self.previews[song_id]
+            elif future.exception() is None and future.result() is None:
+                del self.previews[song_id]
+        if song["id"] not in self.previews:
+            self.submit_preview(song)
+    
+    def submit_preview(self, song):
+        data = self.preload(song)
+        self.previews[song["id"]] = self.executor.submit(self.decode_preview, song, data)
+        while len(self.previews) > self.MAX_FILES:
+            self.previews.popitem(last=False)
+    
+    def decode_preview(self, song, data_future):
+        """解码试听片段（在工作线程中运行）
+        
+        WAV 只读取试听窗口内的帧，MP3 按平均码率截取窗口附近的字节（从完整的帧开始），
+        Ogg 没有文件头无法解码，仍解码整首歌后截取。
+        """
+        data = data_future.result()
+        if self.wanted != song["id"]:
+            return None  # 已切换到其他歌曲，不再解码
+        extension = os.path.splitext(song["file"])[1].lower()
+        window = None
+        if extension == ".wav":
+            window = self.wav_window(data)
+        elif extension == ".mp3":
+            window = self.mp3_window(data, song["duration"])
+        
+        sound = pygame.mixer.Sound(file=io.BytesIO(data if window is None else window))
+        frequency, size, channels = pygame.mixer.get_init()
+        frame_bytes = abs(size) // 8 * channels
+        raw = sound.get_raw()
+        frames = len(raw) // frame_bytes
+        start = int(frames * self.PREVIEW_START) * frame_bytes if window is None else 0
+        length = int(self.PREVIEW_LENGTH * frequency / 1000) * frame_bytes
+        return pygame.mixer.Sound(buffer=raw[start:start + length])
+    
+    def wav_window(self, data):
+        """截取试听窗口内的帧，返回新的 WAV 文件内容"""
+        with wave.open(io.BytesIO(data), "rb") as w:
+            params = w.getparams()
+            w.setpos(int(params.nframes * self.PREVIEW_START))
+            frames = w.readframes(int(self.PREVIEW_LENGTH * params.framerate / 1000))
+        output = io.BytesIO()
+        with wave.open(output, "wb") as w:
+            w.setparams(params)
+            w.writeframes(frames)
+        return output.getvalue()
+    
+    def mp3_window(self, data, duration):
+        """截取试听窗口附近的 MP3 帧（多取 1 秒余量），找不到帧头时返回 None"""
+        if duration <= 0:
+            return None
+        tag_size = read_id3(data)[1]
+        audio_size = len(data) - tag_size
+        frame = find_mp3_frame(data, tag_size + int(audio_size * self.PREVIEW_START), verify=True)
+        if frame is None:
+            return None
+        window_size = int(audio_size * (self.PREVIEW_LENGTH + 1000) / (duration * 1000))
+        return data[frame[0]:frame[0] + window_size]
+    
+    def is_busy(self):
+        """有等待开始播放的试听"""
+        return self.wanted is not None and self.wanted != self.playing
+    
+    def update(self):
+        """检查后台任务，试听片段就绪后交叉淡入"""
+        if not self.is_busy():
+            return
+        future = self.previews.get(self.wanted)
+        if future is None or not future.done():
+            return
+        if future.exception() is not None:
+            print(f"无法试听: {future.exception()}")
+            del self.previews[self.wanted]
+            self.playing = self.wanted
+            return
+        if future.result() is None:
+            # 解码开始前歌曲被切换过，解码已放弃: 重新提交
+            self.submit_preview(self.wanted_song)
+            return
+        
+        # 旧声道淡出，另一个声道淡入
+        self.channels[self.channel_index].fadeout(self.PREVIEW_FADE_MS)
+        self.channel_index = 1 - self.channel_index
+        channel = self.channels[self.channel_index]
+        channel.set_volume(self.PREVIEW_VOLUME)
+        channel.play(future.result(), loops=-1, fade_ms=self.PREVIEW_FADE_MS)
+        self.playing = self.wanted
+    
+    def stop_preview(self):
+        for channel in self.channels:
+            channel.fadeout(self.PREVIEW_FADE_MS)
+        self.wanted = None
+        self.wanted_song = None
+        self.playing = None
+    
+    def music_source(self, song):
+        """已在内存中的歌曲文件（file-like），未就绪时返回 None"""
+        future = self.files.get(song["file"])
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return io.BytesIO(future.result())
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
 # 音乐库系统
 class MusicLibrary:
-    def __init__(self):
+    """歌曲库: 内置歌曲 + 扫描 Music/ 目录得到的歌曲
+    
+    扫描结果保存在索引文件中，只有修改时间或大小变化的文件才重新读取元数据。
+    """
+    def __init__(self, directory=MUSIC_DIR, index_path=MUSIC_INDEX_FILE):
+        self.directory = directory
+        self.index_path = index_path
         self.songs = []
+        self.by_id = {}
+        self.by_title = {}
+        self.by_artist = {}
         self.load_songs()
     
     def load_songs(self):
@@ -406,33 +2088,544 @@ class MusicLibrary:
                 "file": "Music/song12.mp3"
             }
         ]
+        
+        # 目录中的其他歌曲
+        builtin_files = {os.path.normpath(song["file"]) for song in self.songs}
+        for song in self.scan_directory():
+            if os.path.normpath(song["file"]) not in builtin_files:
+                self.songs.append(song)
+        
+        self.by_id = {song["id"]: song for song in self.songs}
+        self.by_title = {}
+        self.by_artist = {}
+        for song in self.songs:
+            self.by_title.setdefault(song["title"], []).append(song)
+            self.by_artist.setdefault(song["artist"], []).append(song)
+    
+    def scan_directory(self):
+        """扫描音乐目录，返回歌曲列表（按文件名排序）"""
+        if not os.path.isdir(self.directory):
+            return []
+        
+        index = self.load_index()
+        entries = {}
+        changed = False
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.lower().endswith(MUSIC_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            cached = index.get(entry.name)
+            if cached and cached["mtime"] == stat.st_mtime and cached["size"] == stat.st_size:
+                entries[entry.name] = cached
+                continue
+            
+            try:
+                meta = read_audio_metadata(entry.path)
+            except Exception as e:
+                print(f"读取歌曲信息错误 {entry.name}: {e}")
+                continue
+            # 读不出时长的歌曲无法生成谱面，记入索引但不加入曲库，避免每次启动重复读取
+            song = None
+            if meta["duration"] and meta["duration"] >= 1:
+                song = self.make_song(entry.name, meta)
+            else:
+                print(f"无法读取歌曲时长，已跳过 {entry.name}")
+            entries[entry.name] = {"mtime": stat.st_mtime, "size": stat.st_size, "song": song}
+            changed = True
+        
+        if changed or len(entries) != len(index):
+            self.save_index(entries)
+        return [entries[name]["song"] for name in sorted(entries) if entries[name]["song"]]
+    
+    def make_song(self, filename, meta):
+        """由文件元数据生成歌曲条目，缺少的字段使用默认值"""
+        path = os.path.join(self.directory, filename)
+        song_id = "track_" + hashlib.blake2b(filename.encode("utf-8"), digest_size=6).hexdigest()
+        bpm = meta["bpm"] or DEFAULT_BPM
+        # 按 BPM 估计难度系数
+        base = min(1.6, max(0.6, bpm / DEFAULT_BPM))
+        return {
+            "id": song_id,
+            "title": meta["title"] or os.path.splitext(filename)[0],
+            "artist": meta["artist"] or "未知艺术家",
+            "duration": int(round(meta["duration"])),
+            "difficulty": {"简单": round(base * 0.7, 1), "中等": round(base, 1), "困难": round(base * 1.5, 1)},
+            "bpm": bpm,
+            "file": path
+        }
+    
+    def load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MUSIC_INDEX_VERSION and data.get("directory") == self.directory:
+                return data["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+    
+    def save_index(self, entries):
+        data = {"version": MUSIC_INDEX_VERSION, "directory": self.directory, "files": entries}
+        try:
+            with open(self.index_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        except Exception as e:
+            print(f"保存歌曲索引错误: {e}")
+    
+    def get_song_by_id(self, song_id):
+        """根据ID获取歌曲"""
+        return self.by_id.get(song_id)
+    
+    def find_by_title(self, title):
+        return self.by_title.get(title, [])
+    
+    def find_by_artist(self, artist):
+        return self.by_artist.get(artist, [])
+    
+    def get_all_songs(self):
+        """获取所有歌曲"""
+        return self.songs
+
+# 资源管理
+RESOURCE_CACHE_DIR = "resource_cache"
+BACKGROUND_VERSION = 1  # 背景的生成方式改变时加一，旧的缓存图片不再使用
+BACKGROUND_SEED = 2024  # 背景固定使用同一种子，缓存图片与重新生成的结果一致
+FONT_SPECS = {
+    "title": ("Arial", 72, True),
+    "large": ("Arial", 48, True),
+    "medium": ("Arial", 36, False),
+    "small": ("Arial", 28, False),
+    "tiny": ("Arial", 22, False),
+}
+
+class ResourceManager:
+    """字体和背景在第一次使用时加载，也可以在后台线程中提前加载
+    
+    第一次调用 SysFont 会扫描系统字体（可能需要数百毫秒）；生成的背景保存为图片，
+    之后启动时直接读取。
+    """
+    def __init__(self, cache_dir=RESOURCE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.fonts = {}  # 名称 -> Font
+        self.background = None
+        self.lock = threading.RLock()  # 主线程与后台线程不会重复加载同一资源
+        self.future = None  # 后台预加载任务
+    
+    def font(self, name):
+        """按 FONT_SPECS 中的名称获取字体"""
+        font = self.fonts.get(name)
+        if font is None:
+            with self.lock:
+                font = self.fonts.get(name)
+                if font is None:
+                    family, size, bold = FONT_SPECS[name]
+                    font = pygame.font.SysFont(family, size, bold=bold)
+                    self.fonts[name] = font
+        return font
+    
+    def background_path(self):
+        return os.path.join(self.cache_dir, f"background_v{BACKGROUND_VERSION}.png")
+    
+    def get_background(self):
+        """1280x720 的菜单背景，优先读取磁盘缓存"""
+        if self.background is None:
+            with self.lock:
+                if self.background is None:
+                    self.background = self.load_background()
+        return self.background
+    
+    def load_background(self):
+        path = self.background_path()
+        if os.path.exists(path):
+            try:
+                return pygame.image.load(path)
+            except (pygame.error, OSError) as e:
+                print(f"背景缓存无法读取，重新生成: {e}")
+        
+        background = self.generate_background()
+        # 先写临时文件再替换，中途退出不会留下损坏的缓存（扩展名决定图片格式）
+        temp_path = os.path.join(self.cache_dir, f"background_{os.getpid()}.tmp.png")
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            pygame.image.save(background, temp_path)
+            os.replace(temp_path, path)
+        except (pygame.error, OSError) as e:
+            print(f"无法保存背景缓存: {e}")
+        return background
+    
+    def generate_background(self):
+        """生成动态背景"""
+        rng = random.Random(BACKGROUND_SEED)
+        background = pygame.Surface((1280, 720))
+        background.fill(BACKGROUND)
+        for i in range(100):
+            x = rng.randint(0, 1279)
+            y = rng.randint(0, 719)
+            radius = rng.randint(2, 10)
+            r = rng.randint(50, 150)
+            g = rng.randint(50, 150)
+            b = rng.randint(100, 200)
+            color = (r, g, b)
+            pygame.draw.circle(background, color, (x, y), radius)
+        
+        # 添加游戏名称
+        name_surf = self.font("title").render(GAME_NAME, True, PRIMARY)
+        background.blit(name_surf, (640 - name_surf.get_width()//2, 100))
+        return background
+    
+    def start_preload(self):
+        """在后台线程中加载全部字体和背景"""
+        if self.future is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+            self.future = executor.submit(self.preload)
+            executor.shutdown(wait=False)
+    
+    def preload(self):
+        for name in FONT_SPECS:
+            self.font(name)
+        self.get_background()
+    
+    def is_ready(self):
+        """后台预加载已结束（未启动时视为就绪，资源在使用时加载）"""
+        if self.future is None:
+            return True
+        if not self.future.done():
+            return False
+        if self.future.exception() is not None:
+            print(f"后台加载资源失败: {self.future.exception()}")
+        self.future = None
+        return True
+
+# 进度日志
+PROGRESS_FILE = "game_progress.json"  # 快照
+PROGRESS_JOURNAL_FILE = "game_progress.journal"  # 快照之后的记录，每行一条 JSON
+PROGRESS_VERSION = 2
+JOURNAL_COMPACT_RECORDS = 200  # 日志积累多少条记录后合并进快照
+
+class ProgressJournal:
+    """只追加的进度日志: 每局结果、成就解锁、成就计数器和设置改动各写一行
+    
+    进度状态只在主线程中修改；文件写入交给单个后台线程按提交顺序执行，不阻塞帧循环。
+    日志变长后把状态写成快照（临时文件 + os.replace），再清空日志。每条记录带递增的
+    序号，快照记下已包含的最大序号，替换快照后、清空日志前退出也不会重复计算。
+    """
+    def __init__(self, snapshot_path=PROGRESS_FILE, journal_path=PROGRESS_JOURNAL_FILE,
+                 compact_records=JOURNAL_COMPACT_RECORDS):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_records = compact_records
+        self.state = self.empty_state()
+        self.pending = 0  # 快照之后的日志记录数
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.journal_file = None  # 只在写入线程中使用
+    
+    @staticmethod
+    def empty_state():
+        return {
+            "version": PROGRESS_VERSION,
+            "seq": 0,  # 已应用的最后一条记录
+            "games_played": 0,
+            "last_played": None,
+            "songs": {},  # 歌曲 ID -> 成绩汇总
+            "achievements": [],  # 按解锁顺序
+            "counters": {},  # 成就计数器
+            "settings": {},
+            "legacy_completed": 0  # 旧版进度文件只记录了完成歌曲数，作为完成数的下限
+        }
+    
+    @staticmethod
+    def empty_song_result():
+        return {"plays": 0, "best_score": 0, "best_rank": "F", "best_accuracy": 0.0,
+                "max_combo": 0, "last_played": None}
+    
+    @staticmethod
+    def apply(state, record):
+        """把一条记录合并到进度状态"""
+        kind = record["type"]
+        if kind == "play":
+            state["games_played"] += 1
+            state["last_played"] = record["played_at"]
+            result = state["songs"].setdefault(record["song"], ProgressJournal.empty_song_result())
+            result["plays"] += 1
+            result["last_played"] = record["played_at"]
+            if record["score"] > result["best_score"]:
+                result["best_score"] = record["score"]
+                result["best_rank"] = record["rank"]
+            result["best_accuracy"] = max(result["best_accuracy"], record["accuracy"])
+            result["max_combo"] = max(result["max_combo"], record["max_combo"])
+        elif kind == "achievement":
+            if record["id"] not in state["achievements"]:
+                state["achievements"].append(record["id"])
+        elif kind == "counters":
+            state["counters"].update(record["values"])
+        elif kind == "setting":
+            state["settings"][record["name"]] = record["value"]
+        state["seq"] = record["seq"]
+    
+    def load(self):
+        """读取快照并重放之后的日志，返回进度状态"""
+        self.wait()
+        state = self.empty_state()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if "version" in data:
+                state.update(data)
+            else:
+                # 旧版进度文件只记录了完成的歌曲（最早的版本只有数量）和设置
+                for song_id in data.get("completed_song_ids", []):
+                    state["songs"][song_id] = dict(self.empty_song_result(), plays=1)
+                state["legacy_completed"] = int(data.get("completed_songs", 0))
+                state["last_played"] = data.get("last_played")
+                for name in ("difficulty", "skin"):
+                    if name in data:
+                        state["settings"][name] = data[name]
+        
+        replayed = 0
+        damaged = False
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        damaged = True  # 写到一半时退出留下的残行
+                        break
+                    if record["seq"] > state["seq"]:
+                        self.apply(state, record)
+                        replayed += 1
+        
+        self.state = state
+        self.pending = replayed
+        if damaged or replayed >= self.compact_records:
+            # 重写快照并清空日志，之后的记录不会接在残行后面
+            self.compact()
+        return state
+    
+    def append(self, record):
+        """记录一条进度（主线程调用，立即返回）"""
+        record["seq"] = self.state["seq"] + 1
+        self.apply(self.state, record)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        self.executor.submit(self.write_record, line)
+        self.pending += 1
+        if self.pending >= self.compact_records:
+            self.compact()
+    
+    def compact(self):
+        """在后台把当前状态写成快照，返回 Future"""
+        data = json.dumps(self.state, ensure_ascii=False, indent=2)
+        self.pending = 0
+        return self.executor.submit(self.write_snapshot, data)
+    
+    def wait(self):
+        """等待已提交的写入完成"""
+        self.executor.submit(lambda: None).result()
+    
+    def write_record(self, line):
+        try:
+            if self.journal_file is None:
+                self.journal_file = open(self.journal_path, "a", encoding="utf-8")
+            self.journal_file.write(line)
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+        except OSError as e:
+            print(f"写入进度日志错误: {e}")
+    
+    def write_snapshot(self, data):
+        temp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            
+            # 快照已包含日志中的全部记录
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+            open(self.journal_path, "w").close()
+        except OSError as e:
+            print(f"保存进度快照错误: {e}")
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+# 成绩数据库
+SCORE_DB_FILE = "scores.db"
+LEADERBOARD_SIZE = 5
+
+class ScoreDatabase:
+    """本地成绩库（SQLite）: 排行榜、个人最佳和游玩历史
+    
+    新成绩先放在内存中，由后台线程批量写入（一批一个事务）；查询在主线程进行，
+    尚未写入的成绩会合并到查询结果中。查询结果缓存到下一次后台提交。
+    """
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS plays (
+            id INTEGER PRIMARY KEY,
+            song_id TEXT NOT NULL,
+            difficulty TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            accuracy REAL NOT NULL,
+            rank TEXT NOT NULL,
+            max_combo INTEGER NOT NULL,
+            played_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS plays_by_score ON plays (song_id, difficulty, score DESC)",
+        "CREATE INDEX IF NOT EXISTS plays_by_time ON plays (played_at)",
+        # 单首歌曲的游玩历史
+        "CREATE INDEX IF NOT EXISTS plays_by_song_time ON plays (song_id, difficulty, played_at)",
+    )
+    COLUMNS = ("id", "song_id", "difficulty", "score", "accuracy", "rank", "max_combo", "played_at")
+    
+    def __init__(self, path=SCORE_DB_FILE):
+        self.path = path
+        self.enabled = True
+        self.reader = None  # 主线程的连接，第一次使用时打开
+        self.writer = None  # 只在写入线程中使用
+        self.next_id = None
+        self.unsaved = []  # 等待写入的成绩
+        self.lock = threading.Lock()
+        self.flush_scheduled = False
+        self.committed = 0  # 每提交一批加一，查询缓存据此失效
+        self.cache = {}
+        self.cache_version = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+    
+    def connect(self):
+        """主线程的连接（无法打开时停用成绩库，返回 None）"""
+        if self.reader is None and self.enabled:
+            try:
+                self.reader = sqlite3.connect(self.path)
+                # WAL 模式下后台写入不阻塞主线程的查询
+                self.reader.execute("PRAGMA journal_mode=WAL")
+                for statement in self.SCHEMA:
+                    self.reader.execute(statement)
+                self.reader.commit()
+                self.next_id = self.reader.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM plays").fetchone()[0]
+            except sqlite3.Error as e:
+                print(f"无法打开成绩数据库: {e}")
+                self.enabled = False
+                self.reader = None
+        return self.reader
+    
+    def add(self, song_id, difficulty, score, accuracy, rank, max_combo, played_at):
+        """记录一局成绩（立即返回），返回成绩 ID"""
+        if self.connect() is None:
+            return None
+        row = (self.next_id, song_id, difficulty, int(score), float(accuracy), rank, int(max_combo), played_at)
+        self.next_id += 1
+        with self.lock:
+            self.unsaved.append(row)
+            schedule = not self.flush_scheduled
+            self.flush_scheduled = True
+        if schedule:
+            self.executor.submit(self.flush)
+        return row[0]
+    
+    def flush(self):
+        """把等待中的成绩写入数据库（在写入线程中运行）"""
+        with self.lock:
+            batch = list(self.unsaved)
+            self.flush_scheduled = False
+        if not batch:
+            return
+        try:
+            if self.writer is None:
+                self.writer = sqlite3.connect(self.path)
+                self.writer.execute("PRAGMA synchronous=NORMAL")
+            with self.writer:
+                self.writer.executemany("INSERT OR IGNORE INTO plays VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+        except sqlite3.Error as e:
+            print(f"写入成绩错误: {e}")
+            return
+        # 先让缓存失效再移出内存，查询时两边都有的成绩按 ID 去重
+        self.committed += 1
+        with self.lock:
+            del self.unsaved[:len(batch)]
     
-    def get_song_by_id(self, song_id):
-        """根据ID获取歌曲"""
-        for song in self.songs:
-            if song["id"] == song_id:
-                return song
-        return None
+    def wait(self):
+        """等待已提交的写入完成"""
+        self.executor.submit(lambda: None).result()
     
-    def get_all_songs(self):
-        """获取所有歌曲"""
-        return self.songs
+    def query(self, sql, params):
+        """执行只读查询，结果缓存到下一次后台提交"""
+        if self.cache_version != self.committed:
+            self.cache.clear()
+            self.cache_version = self.committed
+        key = (sql, params)
+        rows = self.cache.get(key)
+        if rows is None:
+            if self.connect() is None:
+                return []
+            rows = self.reader.execute(sql, params).fetchall()
+            self.cache[key] = rows
+        return rows
+    
+    def merge_unsaved(self, rows, song_id, difficulty, key, limit):
+        """把尚未写入的成绩合并进查询结果，按 key 从大到小取前 limit 条"""
+        with self.lock:
+            pending = [row for row in self.unsaved if row[1] == song_id and row[2] == difficulty]
+        if pending:
+            saved = {row[0] for row in rows}
+            rows = sorted(rows + [row for row in pending if row[0] not in saved], key=key, reverse=True)[:limit]
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+    
+    def leaderboard(self, song_id, difficulty, limit=LEADERBOARD_SIZE):
+        """(歌曲, 难度) 的前 limit 名，分数从高到低"""
+        rows = self.query("SELECT * FROM plays WHERE song_id = ? AND difficulty = ? "
+                          "ORDER BY score DESC LIMIT ?", (song_id, difficulty, limit))
+        return self.merge_unsaved(rows, song_id, difficulty, lambda row: row[3], limit)
+    
+    def personal_best(self, song_id, difficulty):
+        best = self.leaderboard(song_id, difficulty, 1)
+        return best[0] if best else None
+    
+    def history(self, song_id, difficulty, limit=LEADERBOARD_SIZE):
+        """(歌曲, 难度) 最近的 limit 次游玩，从新到旧"""
+        rows = self.query("SELECT * FROM plays WHERE song_id = ? AND difficulty = ? "
+                          "ORDER BY played_at DESC, id DESC LIMIT ?", (song_id, difficulty, limit))
+        return self.merge_unsaved(rows, song_id, difficulty, lambda row: (row[7], row[0]), limit)
+    
+    def recent(self, limit=LEADERBOARD_SIZE):
+        """所有歌曲最近的 limit 次游玩（已写入的）"""
+        rows = self.query("SELECT * FROM plays ORDER BY played_at DESC LIMIT ?", (limit,))
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
 
 # 游戏主类
 class PyTonkGame:
-    def __init__(self):
+    def __init__(self, clock=None, headless=False):
+        # 时钟（无显示运行时使用虚拟时钟）
+        self.clock = clock or GameClock()
+        self.headless = headless
+        self.seed_override = None  # 命令行 --seed 指定的谱面种子
+        self.input_source = None  # 自动演奏或脚本输入
+        self.fps = DEFAULT_FPS  # 渲染帧率，窗口创建后改为显示器刷新率
+        self.profiler = FrameProfiler(self.fps)  # F3 开关
+        
+        # 固定步长模拟（见 advance_simulation）
+        self.sim_step = 0
+        self.render_alpha = 0.0
+        self.previous_line = (640, 500)
+        self.song_clock = SongClock(self.clock)
+        self.input_times = InputTimestamps(self.clock)
+        
         # 初始化系统
         self.renderer = AdaptiveRenderer()
-        self.judgment_line = JudgmentLine(self.renderer)
+        self.judgment_line = JudgmentLine(self.renderer, self.clock)
         self.note_system = NoteSystem(self.renderer)
         self.achievements = AchievementSystem()
-        self.calibration = AutoCalibration()
+        self.calibration = AutoCalibration(self.clock)
         self.music_library = MusicLibrary()
         
         # 游戏状态
-        self.game_state = "main_menu"  # main_menu, song_select, playing, pause, results, achievements, settings
+        self.game_state = "main_menu"  # loading, main_menu, song_select, playing, pause, results, achievements, settings
         self.screen = None
-        self.clock = pygame.time.Clock()
         self.start_time = 0
         self.current_time = 0
         self.song_duration = 0
@@ -443,6 +2636,11 @@ class PyTonkGame:
         self.show_tutorial = True
         self.show_calibration = True
         self.current_song_id = None
+        self.note_positions = None
+        
+        # 保留模式渲染状态
+        self.scene_key = None  # 当前屏幕上已合成的静态界面
+        self.dirty_rects = []  # 等待重绘的屏幕区域
         
         # 游戏统计
         self.game_stats = {
@@ -464,6 +2662,19 @@ class PyTonkGame:
             'unlocked_achievements': 0
         }
         
+        # 文字渲染缓存（所有界面共用）
+        self.text_cache = TextCache()
+        self.chart_cache = ChartCache()
+        self.audio_loader = AudioLoader()
+        self.note_atlas = NoteAtlas()
+        self.resources = ResourceManager()
+        self.splash_font = None
+        self.progress = ProgressJournal()
+        self.scores = ScoreDatabase()
+        self.session_unlocks = []  # 本局解锁的成就
+        self.achievement_toast = None  # (成就 ID, 解锁时刻)
+        self.last_play_id = None  # 上一局在成绩库中的 ID
+        
         # 设备优化
         self.device_type = "tablet"  # 自动检测或手动设置
         self.vibration_enabled = True
@@ -472,8 +2683,11 @@ class PyTonkGame:
         self.load_resources()
         
         # 初始化回放系统
-        self.replay_data = []
+        self.replay = None  # 正在录制的回放
+        self.replay_data = None  # 上一局的回放（二进制）
         self.recording = False
+        self.replaying = False  # 正在根据回放重建状态
+        self.replay_player = None
         self.playback_speed = 1.0
         
         # 初始化编辑器
@@ -482,23 +2696,18 @@ class PyTonkGame:
         self.selected_note_type = "tap"
         
         # 加载歌曲完成状态
+        self.song_page = 0
+        self.completed_song_ids = set()
+        self.song_results = {}  # 歌曲 ID -> 成绩汇总（来自进度日志）
         self.load_progress()
     
     def load_resources(self):
-        """加载游戏资源"""
-        # 先加载字体
-        self.title_font = pygame.font.SysFont("Arial", 72, bold=True)
-        self.large_font = pygame.font.SysFont("Arial", 48, bold=True)
-        self.medium_font = pygame.font.SysFont("Arial", 36)
-        self.small_font = pygame.font.SysFont("Arial", 28)
-        self.tiny_font = pygame.font.SysFont("Arial", 22)
-        
-        # 创建动态背景
-        self.background = pygame.Surface((1280, 720))
-        self.generate_dynamic_background()
+        """加载游戏资源（字体和背景由 ResourceManager 在第一次使用时加载）"""
+        self.scaled_background = None
         
         # 加载按钮
         self.buttons = {
+            "replay": {"rect": (840, 550, 200, 60), "text": "观看回放"},
             "play": {"rect": (500, 300, 280, 60), "text": "开始游戏"},
             "achievements": {"rect": (500, 380, 280, 60), "text": "成就系统"},
             "settings": {"rect": (500, 460, 280, 60), "text": "游戏设置"},
@@ -516,9 +2725,16 @@ class PyTonkGame:
             "skin2": {"rect": (500, 350, 150, 60), "text": "霓虹"},
             "skin3": {"rect": (700, 350, 150, 60), "text": "柔和"},
             "save": {"rect": (500, 600, 200, 60), "text": "保存关卡"},
-            "add_note": {"rect": (1000, 100, 200, 50), "text": "添加音符"}
+            "load": {"rect": (750, 600, 200, 60), "text": "加载关卡"},
+            "add_note": {"rect": (1000, 100, 200, 50), "text": "添加音符"},
+            "prev_page": {"rect": (900, 600, 120, 40), "text": "上一页"},
+            "next_page": {"rect": (1040, 600, 120, 40), "text": "下一页"}
         }
         
+        # 歌曲选择按钮（每页的位置固定，对应当前页的歌曲）
+        for slot in range(SONGS_PER_PAGE):
+            self.buttons[f"song_slot{slot}"] = {"rect": (900, 110 + slot * 80, 200, 40), "text": "选择"}
+        
         # 音符类型按钮
         y_pos = 200
         for note_type in self.note_system.note_types:
@@ -528,37 +2744,110 @@ class PyTonkGame:
             }
             y_pos += 50
     
-    def generate_dynamic_background(self):
-        """生成动态背景"""
-        self.background.fill(BACKGROUND)
-        for i in range(100):
-            x = random.randint(0, 1279)
-            y = random.randint(0, 719)
-            radius = random.randint(2, 10)
-            r = random.randint(50, 150)
-            g = random.randint(50, 150)
-            b = random.randint(100, 200)
-            color = (r, g, b)
-            pygame.draw.circle(self.background, color, (x, y), radius)
-        
-        # 添加游戏名称
-        name_surf = self.title_font.render(GAME_NAME, True, PRIMARY)
-        self.background.blit(name_surf, (640 - name_surf.get_width()//2, 100))
+    # 字体和背景按需加载，第一次访问时可能阻塞（run 中已在后台提前加载）
+    @property
+    def title_font(self):
+        return self.resources.font("title")
+    
+    @property
+    def large_font(self):
+        return self.resources.font("large")
+    
+    @property
+    def medium_font(self):
+        return self.resources.font("medium")
+    
+    @property
+    def small_font(self):
+        return self.resources.font("small")
+    
+    @property
+    def tiny_font(self):
+        return self.resources.font("tiny")
+    
+    @property
+    def background(self):
+        return self.resources.get_background()
+    
+    def get_scaled_background(self):
+        """获取按当前缩放比例缩放好的背景，只在分辨率变化时重新缩放"""
+        size = (int(1280 * self.renderer.scale_factor), int(720 * self.renderer.scale_factor))
+        if self.scaled_background is None or self.scaled_background.get_size() != size:
+            scaled = pygame.transform.scale(self.background, size)
+            # 转换为屏幕像素格式，加快每帧的 blit
+            if pygame.display.get_surface() is not None:
+                scaled = scaled.convert()
+            self.scaled_background = scaled
+        return self.scaled_background
     
     def start_game(self, song_id=None):
         """开始新游戏"""
         if song_id is None:
             song_id = random.choice([song["id"] for song in self.music_library.songs])
         
-        self.current_song_id = song_id
         song = self.music_library.get_song_by_id(song_id)
         
         if song is None:
             print(f"错误: 找不到歌曲 {song_id}")
             return
-            
+        
+        # 生成谱面（默认种子固定，重新开始时直接使用缓存）
+        seed = chart_seed(song_id, self.difficulty) if self.seed_override is None else self.seed_override
+        self.session_unlocks = []
+        self.achievement_toast = None
+        self.input_times.reset()
+        self.prepare_song(song, self.difficulty, seed)
+        self.game_state = "playing"
+        
+        # 开始回放记录（帧时间为歌曲时间，从 0 开始）
+        self.replay = Replay(song_id, self.difficulty, seed, self.note_system.notes.checksum(),
+                             0, self.judgment_line.movement_type)
+        self.recording = True
+        
+        # 尝试播放音乐（已预读时直接从内存加载，不再读盘）
+        audio = False
+        self.audio_loader.stop_preview()
+        try:
+            source = self.audio_loader.music_source(song)
+            if source is not None:
+                pygame.mixer.music.load(source, os.path.splitext(song["file"])[1])
+            else:
+                pygame.mixer.music.load(song["file"])
+            pygame.mixer.music.play()
+            audio = True
+            print(f"正在播放: {song['title']}")
+        except Exception as e:
+            print(f"无法播放音乐: {e}")
+        
+        # 歌曲时间从音乐开始播放时算起
+        self.start_time = self.clock.get_ticks()
+        self.song_clock.start(audio)
+        
+        # 如果启用了校准，运行校准过程
+        if self.show_calibration:
+            self.calibration.start_calibration(0)
+    
+    def pause_game(self):
+        """暂停: 歌曲时钟和音乐一起停止"""
+        self.game_state = "pause"
+        self.song_clock.pause()
+    
+    def resume_game(self):
+        """继续: 从暂停的位置接着计时"""
         self.game_state = "playing"
-        self.start_time = pygame.time.get_ticks()
+        self.song_clock.resume()
+    
+    def quit_song(self):
+        """中途退出当前歌曲"""
+        self.record_counters()
+        self.song_clock.resume()
+        pygame.mixer.music.stop()
+        self.recording = False
+        self.game_state = "main_menu"
+    
+    def prepare_song(self, song, difficulty, seed):
+        """重置一局游戏的状态并按种子生成谱面"""
+        self.current_song_id = song["id"]
         self.current_time = 0
         self.song_position = 0
         self.song_duration = song["duration"] * 1000  # 转换为毫秒
@@ -577,32 +2866,55 @@ class PyTonkGame:
             'games_played': self.game_stats['games_played'],
             'play_time': self.game_stats['play_time'],
             'rank': "F",
-            'difficulty': self.difficulty,
+            'difficulty': difficulty,
             'completed_songs': self.game_stats['completed_songs'],
             'unlocked_achievements': self.game_stats['unlocked_achievements']
         }
         
-        # 生成音符
+        # 生成音符: 优先使用编译好的缓存谱面
         self.note_system = NoteSystem(self.renderer)
-        song_difficulty = song["difficulty"].get(self.difficulty, 1.0)
-        self.note_system.generate_song_notes(self.song_duration, song_difficulty)
+        key = ChartCache.make_key(song["id"], difficulty, seed)
+        notes = self.chart_cache.get(key)
+        if notes is not None:
+            self.note_system.use_notes(notes.with_fresh_state())
+        else:
+            song_difficulty = song["difficulty"].get(difficulty, 1.0)
+            self.note_system.generate_song_notes(song["duration"], song_difficulty, seed, song["bpm"])
+            self.chart_cache.put(key, self.note_system.notes)
         self.game_stats['total_notes'] = len(self.note_system.notes)
+        self.note_positions = None
+        self.judgment_line.reset(seed)
         
-        # 开始回放记录
-        self.replay_data = []
-        self.recording = True
-        
-        # 尝试播放音乐
+        # 固定步长模拟状态
+        self.sim_step = 0
+        self.render_alpha = 0.0
+        self.previous_line = (self.judgment_line.x, self.judgment_line.y)
+    
+    def resimulate_replay(self, replay):
+        """根据回放确定性地重建整局游戏状态，返回判定线采样不一致的次数"""
+        player = ReplayPlayer(self, replay)
+        player.close()
+        return player.desync
+    
+    def start_replay(self):
+        """播放上一局的回放"""
+        if not self.replay_data:
+            return
         try:
-            pygame.mixer.music.load(song["file"])
-            pygame.mixer.music.play()
-            print(f"正在播放: {song['title']}")
-        except Exception as e:
-            print(f"无法播放音乐: {e}")
-        
-        # 如果启用了校准，运行校准过程
-        if self.show_calibration:
-            self.calibration.start_calibration()
+            # 刚录制的回放已带有关键帧，不需要重新模拟
+            replay = self.replay if self.replay is not None and not self.recording else self.replay_data
+            player = ReplayPlayer(self, replay)
+        except ValueError as e:
+            print(f"无法播放回放: {e}")
+            return
+        self.replay_player = player
+        self.game_state = "replay"
+    
+    def stop_replay(self):
+        """退出回放"""
+        if self.replay_player is not None:
+            self.replay_player.close()
+            self.replay_player = None
     
     def handle_input(self, event):
         """处理输入事件"""
@@ -619,11 +2931,8 @@ class PyTonkGame:
             if self.game_state == "main_menu":
                 self.handle_menu_click(touch_x, touch_y)
             elif self.game_state == "playing":
-                # 转换到游戏坐标系
-                game_x, game_y = self.renderer.transform_pos(touch_x, touch_y)
-                
-                # 处理音符判定
-                self.check_note_hit(game_x, game_y)
+                # 处理音符判定（屏幕坐标，按点击发生的时刻判定）
+                self.check_note_hit(touch_x, touch_y, self.input_times.record(event))
             elif self.game_state == "song_select":
                 self.handle_song_select(touch_x, touch_y)
             elif self.game_state == "pause":
@@ -635,20 +2944,50 @@ class PyTonkGame:
                 self.handle_settings_click(touch_x, touch_y)
             elif self.game_state == "editor":
                 self.handle_editor_click(touch_x, touch_y)
+            elif self.game_state == "results":
+                self.handle_results_click(touch_x, touch_y)
+            elif self.game_state == "replay":
+                self.handle_replay_click(touch_x, touch_y)
+        
+        elif event.type == MOUSEMOTION and self.game_state == "replay":
+            # 按住进度条拖动
+            if event.buttons[0]:
+                self.handle_replay_click(*event.pos)
+        
+        elif event.type == MOUSEMOTION and self.game_state == "song_select":
+            # 鼠标悬停的歌曲: 试听（当前页的歌曲在进入选曲界面和翻页时已开始预读）
+            for slot, song in enumerate(self.get_page_songs()):
+                if self.is_button_clicked(f"song_slot{slot}", *event.pos):
+                    self.audio_loader.request_preview(song)
+                    break
+        
+        elif event.type == KEYDOWN and self.game_state == "replay":
+            if event.key == K_ESCAPE:
+                self.game_state = "main_menu"
+            elif event.key == K_SPACE:
+                self.replay_player.paused = not self.replay_player.paused
+            elif event.key == K_LEFT:
+                self.replay_player.seek(self.replay_player.position - 5000)
+            elif event.key == K_RIGHT:
+                self.replay_player.seek(self.replay_player.position + 5000)
+            elif event.key == K_UP:
+                self.replay_player.change_speed(1)
+            elif event.key == K_DOWN:
+                self.replay_player.change_speed(-1)
         
         elif event.type == KEYDOWN:
             if event.key == K_ESCAPE:
                 if self.game_state == "playing":
-                    self.game_state = "pause"
+                    self.pause_game()
                 elif self.game_state == "pause":
-                    self.game_state = "playing"
-                elif self.game_state in ["song_select", "achievements", "settings", "editor"]:
+                    self.resume_game()
+                elif self.game_state in ["song_select", "achievements", "settings", "editor", "results"]:
                     self.game_state = "main_menu"
     
     def handle_menu_click(self, x, y):
         """处理主菜单点击"""
         if self.is_button_clicked("play", x, y):
-            self.game_state = "song_select"
+            self.open_song_select()
         elif self.is_button_clicked("achievements", x, y):
             self.game_state = "achievements"
         elif self.is_button_clicked("settings", x, y):
@@ -656,22 +2995,45 @@ class PyTonkGame:
         elif self.is_button_clicked("editor", x, y):
             self.game_state = "editor"
             self.editor_active = True
-            self.editor_time = pygame.time.get_ticks()
+            self.editor_time = self.clock.get_ticks()
         elif self.is_button_clicked("exit", x, y):
-            self.save_progress()
-            pygame.quit()
-            sys.exit()
+            self.shutdown()
+    
+    def open_song_select(self):
+        """进入选曲界面"""
+        self.game_state = "song_select"
+        self.audio_loader.preload_page(self.get_page_songs())
+    
+    def get_page_songs(self):
+        """歌曲选择界面当前页的歌曲"""
+        start = self.song_page * SONGS_PER_PAGE
+        return self.music_library.get_all_songs()[start:start + SONGS_PER_PAGE]
+    
+    def get_page_count(self):
+        return max(1, math.ceil(len(self.music_library.get_all_songs()) / SONGS_PER_PAGE))
     
     def handle_song_select(self, x, y):
         """处理歌曲选择"""
         # 检查歌曲选择
-        for song in self.music_library.get_all_songs():
-            btn_id = f"song_{song['id']}"
-            if self.is_button_clicked(btn_id, x, y):
+        for slot, song in enumerate(self.get_page_songs()):
+            if self.is_button_clicked(f"song_slot{slot}", x, y):
                 self.start_game(song["id"])
                 return
         
+        # 翻页
+        if self.is_button_clicked("prev_page", x, y) and self.song_page > 0:
+            self.song_page -= 1
+            self.audio_loader.preload_page(self.get_page_songs())
+            self.invalidate()
+            return
+        if self.is_button_clicked("next_page", x, y) and self.song_page < self.get_page_count() - 1:
+            self.song_page += 1
+            self.audio_loader.preload_page(self.get_page_songs())
+            self.invalidate()
+            return
+        
         # 检查难度选择
+        previous_difficulty = self.difficulty
         if self.is_button_clicked("easy", x, y):
             self.difficulty = "简单"
         elif self.is_button_clicked("medium", x, y):
@@ -680,18 +3042,48 @@ class PyTonkGame:
             self.difficulty = "困难"
         elif self.is_button_clicked("back", x, y):
             self.game_state = "main_menu"
+        
+        # 只重绘与难度有关的文字
+        if self.difficulty != previous_difficulty:
+            self.record_progress({"type": "setting", "name": "difficulty", "value": self.difficulty})
+            self.invalidate((500, 600, 400, 35))
+            y_pos = 120
+            for _ in self.get_page_songs():
+                self.invalidate((200, y_pos + 40, 600, 35))
+                y_pos += 80
+    
+    def handle_results_click(self, x, y):
+        """处理结果画面点击"""
+        if self.is_rect_clicked((440, 550, 200, 60), x, y):
+            self.start_game(self.current_song_id)
+        elif self.is_rect_clicked((640, 550, 200, 60), x, y):
+            self.game_state = "main_menu"
+        elif self.replay_data and self.is_button_clicked("replay", x, y):
+            self.start_replay()
+    
+    def handle_replay_click(self, x, y):
+        """处理回放画面点击: 返回或在进度条上跳转"""
+        if self.is_button_clicked("back", x, y):
+            self.game_state = "results"
+            return
+        
+        bar_x, bar_y, bar_width, bar_height = self.get_progress_bar_rect()
+        margin = self.renderer.transform_size(20)
+        if bar_x <= x <= bar_x + bar_width and bar_y - margin <= y <= bar_y + bar_height + margin:
+            player = self.replay_player
+            player.seek((x - bar_x) / bar_width * player.duration)
     
     def handle_pause_click(self, x, y):
         """处理暂停菜单点击"""
         if self.is_button_clicked("resume", x, y):
-            self.game_state = "playing"
+            self.resume_game()
         elif self.is_button_clicked("restart", x, y):
             if self.current_song_id:
                 self.start_game(self.current_song_id)
             else:
                 self.start_game()
         elif self.is_button_clicked("menu", x, y):
-            self.game_state = "main_menu"
+            self.quit_song()
     
     def handle_settings_click(self, x, y):
         """处理设置菜单点击"""
@@ -706,6 +3098,13 @@ class PyTonkGame:
             self.skin = "neon"
         elif self.is_button_clicked("skin3", x, y):
             self.skin = "pastel"
+        else:
+            return
+        
+        if self.skin != self.progress.state["settings"].get("skin", "default"):
+            self.record_progress({"type": "setting", "name": "skin", "value": self.skin})
+        # 只重绘当前设置列表
+        self.invalidate((200, 450, 600, 150))
     
     def handle_editor_click(self, x, y):
         """处理编辑器点击"""
@@ -714,6 +3113,8 @@ class PyTonkGame:
             self.editor_active = False
         elif self.is_button_clicked("save", x, y):
             self.save_level()
+        elif self.is_button_clicked("load", x, y):
+            self.load_level()
         elif self.is_button_clicked("add_note", x, y):
             lane = random.randint(0, 7)
             self.note_system.add_note(self.selected_note_type, self.editor_time, lane)
@@ -726,140 +3127,284 @@ class PyTonkGame:
     def is_button_clicked(self, button_id, x, y):
         """检查按钮是否被点击"""
         if button_id in self.buttons:
-            rect = self.buttons[button_id]["rect"]
-            scaled_rect = self.renderer.transform_rect(rect)
-            btn_rect = pygame.Rect(scaled_rect)
-            return btn_rect.collidepoint(x, y)
+            return self.is_rect_clicked(self.buttons[button_id]["rect"], x, y)
         return False
     
-    def check_note_hit(self, x, y):
-        """检查音符是否被击中"""
-        current_time = pygame.time.get_ticks()
-        adjusted_time = self.calibration.adjust_time(current_time)
+    def is_rect_clicked(self, rect, x, y):
+        """检查基准分辨率下的矩形区域是否被点击"""
+        scaled_rect = self.renderer.transform_rect(rect)
+        btn_rect = pygame.Rect(scaled_rect)
+        return btn_rect.collidepoint(x, y)
+    
+    def check_note_hit(self, x, y, current_time=None):
+        """检查音符是否被击中（x, y 为屏幕坐标，current_time 为系统时间）"""
+        if current_time is None:
+            song_time = self.song_clock.now()
+        else:
+            song_time = self.song_clock.at(current_time)
+        # 先把模拟推进到点击时刻，判定不受渲染帧率影响
+        if self.game_state == "playing":
+            self.advance_simulation(song_time)
+        game_x, game_y = self.renderer.inverse_transform_pos(x, y)
+        self.judge_tap(game_x, game_y, song_time)
+    
+    def judge_tap(self, x, y, current_time):
+        """判定一次点击（x, y 为基准分辨率坐标）"""
+        if self.recording:
+            self.replay.record_input(current_time, x, y)
         
-        for note in self.note_system.active_notes[:]:
-            if note['state'] != 'active':
-                continue
-                
-            # 计算音符位置
-            note_x, note_y = self.calculate_note_position(note)
-            
-            # 计算距离
-            distance = math.sqrt((x - note_x)**2 + (y - note_y)**2)
-            hit_threshold = self.renderer.transform_size(30)
-            
-            if distance < hit_threshold:
-                # 计算准确度
-                time_diff = abs(current_time - note['time'])
-                self.calibration.add_sample(current_time, note['time'])
-                
-                # 评分逻辑
-                if time_diff < 50:
-                    score = self.note_system.note_types[note['type']]['score'] * 1.2
-                    self.game_stats['perfect_hits'] += 1
-                    effect = "perfect"
-                elif time_diff < 100:
-                    score = self.note_system.note_types[note['type']]['score'] * 1.0
-                    self.game_stats['good_hits'] += 1
-                    effect = "good"
-                else:
-                    score = self.note_system.note_types[note['type']]['score'] * 0.8
-                    effect = "ok"
-                
-                # 应用连击奖励
-                combo_bonus = 1.0 + (min(self.game_stats['combo'], 100) / 100.0)
-                score *= combo_bonus
-                
-                # 更新分数和连击
-                self.game_stats['score'] += int(score)
-                self.game_stats['combo'] += 1
-                self.game_stats['max_combo'] = max(self.game_stats['max_combo'], self.game_stats['combo'])
-                self.game_stats['hits'] += 1
-                
-                # 特殊音符统计
-                if note['type'] == 'special':
-                    self.game_stats['special_hits'] += 1
-                
-                note['state'] = 'hit'
-                note['hit_time'] = current_time
-                note['effect'] = effect
-                
-                # 从活动音符中移除
-                self.note_system.active_notes.remove(note)
-                break
+        notes = self.note_system.notes
+        positions = self.calculate_note_positions()
+        
+        # 只检查点击位置附近轨道、判定时间窗内的音符
+        hit_threshold = 30
+        candidates = self.note_system.hit_index.query(
+            self.note_system, self.judgment_line, x, y, hit_threshold)
+        if len(candidates) == 0:
+            return
+        
+        # 使用本帧已计算的位置求距离
+        rows = np.searchsorted(positions.indices, candidates)
+        distance = np.hypot(x - positions.x[rows], y - positions.y[rows])
+        
+        # 按时间顺序取第一个命中的音符
+        hits = np.flatnonzero(distance < hit_threshold)
+        if len(hits) == 0:
+            return
+        index = int(candidates[hits[0]])
+        note_time = int(notes.time[index])
+        note_type = int(notes.type[index])
+        base_score = int(self.note_system.type_scores[note_type])
+        
+        # 计算准确度
+        time_diff = abs(current_time - note_time)
+        if not self.replaying:
+            self.calibration.add_sample(current_time, note_time)
+        
+        # 评分逻辑
+        if time_diff < 50:
+            score = base_score * 1.2
+            self.game_stats['perfect_hits'] += 1
+            effect = "perfect"
+        elif time_diff < 100:
+            score = base_score * 1.0
+            self.game_stats['good_hits'] += 1
+            effect = "good"
+        else:
+            score = base_score * 0.8
+            effect = "ok"
+        
+        # 应用连击奖励
+        combo_bonus = 1.0 + (min(self.game_stats['combo'], 100) / 100.0)
+        score *= combo_bonus
+        
+        # 更新分数和连击
+        self.game_stats['score'] += int(score)
+        self.game_stats['combo'] += 1
+        self.game_stats['max_combo'] = max(self.game_stats['max_combo'], self.game_stats['combo'])
+        self.game_stats['hits'] += 1
+        
+        # 特殊音符统计
+        if note_type == NOTE_TYPE_CODES['special']:
+            self.game_stats['special_hits'] += 1
+            self.notify_achievements("special_hit")
+        self.notify_achievements("hit", score=self.game_stats['score'], combo=self.game_stats['max_combo'])
+        
+        # 标记击中（同时从活动音符中移除）
+        self.note_system.hit_note(index, current_time, effect)
+    
+    def notify_achievements(self, event, amount=1, **data):
+        """把游戏事件交给成就系统，新解锁的成就写入进度并在游戏中提示"""
+        if self.replaying:
+            return
+        for achievement_id in self.achievements.emit(event, amount, **data):
+            self.session_unlocks.append(achievement_id)
+            self.achievement_toast = (achievement_id, self.clock.get_ticks())
+            self.record_progress({"type": "achievement", "id": achievement_id})
+        self.game_stats['unlocked_achievements'] = len(self.achievements.unlocked)
     
-    def calculate_note_position(self, note):
-        """计算音符位置（考虑判定线运动）"""
+    def calculate_note_position(self, indices):
+        """计算音符位置（考虑判定线运动），indices 可以是单个下标或下标数组"""
+        notes = self.note_system.notes
         base_y = self.judgment_line.y - 200
-        progress = min(1.0, max(0.0, note['progress']))
+        progress = np.clip(notes.progress[indices], 0.0, 1.0)
         
         # 音符最终位置
-        final_x = self.judgment_line.x + (note['lane'] * 100 - 350)
+        final_x = self.judgment_line.x + (notes.lane[indices] * 100.0 - 350.0)
         final_y = self.judgment_line.y
         
         # 当前位置
         current_y = base_y + (final_y - base_y) * progress
         return final_x, current_y
     
+    def calculate_note_positions(self):
+        """整批计算所有活动音符的屏幕坐标，同一帧内只计算一次"""
+        note_system = self.note_system
+        line = self.judgment_line
+        renderer = self.renderer
+        key = (note_system, note_system.current_time, note_system.schedule_version,
+               line.x, line.y, renderer.scale_factor, renderer.offset_x, renderer.offset_y)
+        
+        if self.note_positions is None or self.note_positions.key != key:
+            indices = note_system.active_notes
+            x, y = self.calculate_note_position(indices)
+            screen_x, screen_y = renderer.transform_pos(x, y)
+            self.note_positions = NotePositions(key, indices, x, y, screen_x, screen_y)
+        return self.note_positions
+    
     def trigger_vibration(self, duration):
         """触发震动反馈（安卓设备）"""
         # 在Pydroid 3中禁用震动功能
         pass
     
-    def update(self):
-        """更新游戏状态"""
-        self.current_time = pygame.time.get_ticks()
+    def update(self, current_time=None):
+        """更新游戏状态（current_time 为系统时间，游戏中换算为歌曲时间）"""
+        if self.game_state == "playing":
+            song_time = self.song_clock.now() if current_time is None else self.song_clock.at(current_time)
+        if current_time is None:
+            current_time = self.clock.get_ticks()
+        
+        # 启动画面: 等待后台加载字体和背景
+        if self.game_state == "loading":
+            if self.resources.is_ready():
+                print(f"资源加载完成: {(time.perf_counter() - STARTUP_TIME) * 1000:.0f} 毫秒")
+                self.game_state = "main_menu"
+            return
+        
+        # 离开回放画面时结束回放
+        if self.replay_player is not None and self.game_state != "replay":
+            self.stop_replay()
+        
+        # 歌曲试听: 选曲界面中开始就绪的片段，离开后停止
+        if self.game_state == "song_select":
+            self.audio_loader.update()
+        elif self.audio_loader.wanted is not None:
+            self.audio_loader.stop_preview()
+        
+        if self.game_state == "replay":
+            self.replay_player.update(current_time)
+            self.render_alpha = 0.0
+            return
         
         if self.game_state == "playing":
-            # 更新音符系统
-            combo_bonus = self.note_system.update(self.current_time)
-            
-            # 更新游戏统计
-            if self.note_system.active_notes:
-                self.game_stats['misses'] = self.note_system.missed_notes
-                self.game_stats['combo'] = self.note_system.combo
-                self.game_stats['max_combo'] = max(self.game_stats['max_combo'], self.note_system.combo)
-            
-            # 计算准确率
-            if self.game_stats['hits'] + self.game_stats['misses'] > 0:
-                self.game_stats['accuracy'] = self.game_stats['hits'] / (self.game_stats['hits'] + self.game_stats['misses'])
-            
-            # 计算评级
-            self.calculate_rank()
-            
-            # 更新判定线位置
-            self.judgment_line.update()
-            
-            # 校准过程
-            if self.show_calibration:
-                if self.calibration.update_calibration(self.current_time):
-                    self.show_calibration = False
-            
-            # 记录回放数据
-            if self.recording:
-                self.replay_data.append({
-                    'time': self.current_time - self.start_time,
-                    'notes': [n.copy() for n in self.note_system.notes if n['state'] in ['active', 'hit']],
-                    'line_pos': (self.judgment_line.x, self.judgment_line.y, self.judgment_line.angle),
-                    'stats': self.game_stats.copy()
-                })
+            self.advance_simulation(song_time, MAX_SIM_STEPS)
             
             # 检查游戏结束
-            if self.current_time - self.start_time > self.song_duration:
+            if self.current_time > self.song_duration:
                 self.game_state = "results"
                 self.game_stats['games_played'] += 1
                 
                 # 检查是否首次完成这首歌
-                if self.current_song_id and self.game_stats['completed_songs'] < 12:
-                    self.game_stats['completed_songs'] += 1
+                if self.current_song_id and self.current_song_id not in self.completed_song_ids:
+                    self.completed_song_ids.add(self.current_song_id)
+                    self.game_stats['completed_songs'] = self.completed_count()
                 
-                self.achievements.check_achievements(self.game_stats)
+                self.notify_achievements("song_end", stats=self.game_stats,
+                                         completed_songs=self.completed_count(),
+                                         total_songs=len(self.music_library.songs))
+                
+                # 记录本局成绩和新解锁的成就
+                play = {
+                    "type": "play",
+                    "song": self.current_song_id,
+                    "difficulty": self.difficulty,
+                    "score": int(self.game_stats['score']),
+                    "accuracy": round(float(self.game_stats['accuracy']), 4),
+                    "rank": self.game_stats['rank'],
+                    "max_combo": int(self.game_stats['max_combo']),
+                    "played_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+                if not self.headless:
+                    self.last_play_id = self.scores.add(play["song"], play["difficulty"], play["score"],
+                                                        play["accuracy"], play["rank"], play["max_combo"],
+                                                        play["played_at"])
+                self.record_progress(play)
+                self.record_counters()
                 pygame.mixer.music.stop()
+                if self.song_clock.drift_samples:
+                    drift = self.song_clock.drift_stats()
+                    print(f"音频同步: 平均漂移 {drift['mean']:.1f}ms, 最大 {drift['max_abs']:.1f}ms, "
+                          f"输出延迟 {drift['latency']:.1f}ms")
+                if self.input_times.delays:
+                    delay = self.input_times.delay_stats()
+                    print(f"输入时间戳: {delay['count']} 次点击, 判定中扣除的处理延迟 平均 {delay['mean']:.1f}ms, "
+                          f"p95 {delay['p95']:.1f}ms, 最大 {delay['max']:.1f}ms")
+                
+                # 保存本局回放
+                if self.recording:
+                    self.replay_data = self.replay.encode()
+                    self.recording = False
         
         elif self.game_state == "editor":
-            self.editor_time = pygame.time.get_ticks()
+            self.current_time = current_time
+            self.editor_time = self.clock.get_ticks()
             self.note_system.update(self.editor_time)
     
+    def step_time(self, step):
+        """第 step 个模拟步的歌曲时间（整数毫秒，不累积误差）"""
+        return (step * 1000) // SIM_RATE
+    
+    def advance_simulation(self, target_time, max_steps=None):
+        """以固定步长把模拟推进到 target_time，返回是否已追上"""
+        steps = 0
+        next_time = self.step_time(self.sim_step + 1)
+        while next_time <= target_time:
+            if max_steps is not None and steps >= max_steps:
+                self.render_alpha = 1.0
+                return False
+            line = self.judgment_line
+            self.previous_line = (line.x, line.y)
+            self.simulate_frame(next_time)
+            self.sim_step += 1
+            steps += 1
+            
+            # 自动输入（自动演奏/脚本）
+            if self.input_source is not None:
+                self.input_source.feed(self, next_time)
+            next_time = self.step_time(self.sim_step + 1)
+        
+        # 渲染插值系数: 目标时间在上一步与下一步之间的位置
+        last_time = self.step_time(self.sim_step)
+        self.render_alpha = min(1.0, max(0.0, (target_time - last_time) / (next_time - last_time)))
+        return True
+    
+    def simulate_frame(self, current_time):
+        """推进一帧游戏逻辑（回放重建时也使用）"""
+        self.current_time = current_time
+        
+        # 更新音符系统
+        missed_before = self.note_system.missed_notes
+        combo_bonus = self.note_system.update(current_time)
+        if self.note_system.missed_notes > missed_before:
+            self.notify_achievements("miss", int(self.note_system.missed_notes - missed_before))
+        
+        # 更新游戏统计
+        if len(self.note_system.active_notes):
+            self.game_stats['misses'] = self.note_system.missed_notes
+            self.game_stats['combo'] = self.note_system.combo
+            self.game_stats['max_combo'] = max(self.game_stats['max_combo'], self.note_system.combo)
+        
+        # 计算准确率
+        if self.game_stats['hits'] + self.game_stats['misses'] > 0:
+            self.game_stats['accuracy'] = self.game_stats['hits'] / (self.game_stats['hits'] + self.game_stats['misses'])
+        
+        # 计算评级
+        self.calculate_rank()
+        
+        # 更新判定线位置
+        self.judgment_line.update(current_time)
+        
+        # 校准过程
+        if self.show_calibration and not self.replaying:
+            if self.calibration.update_calibration(current_time):
+                self.show_calibration = False
+        
+        # 记录回放数据
+        if self.recording:
+            self.replay.record_frame(current_time, self.judgment_line)
+            if self.replay.keyframe_due(len(self.replay.frame_times)):
+                self.replay.keyframes.append((len(self.replay.frame_times), ReplayPlayer.capture(self)))
+    
     def calculate_rank(self):
         """计算当前评级"""
         accuracy = self.game_stats['accuracy']
@@ -880,88 +3425,109 @@ class PyTonkGame:
         else:
             self.game_stats['rank'] = "F"
     
-    def save_level(self):
-        """保存自定义关卡"""
-        level_data = {
+    def save_level(self, path=CUSTOM_LEVEL_FILE):
+        """保存自定义关卡（二进制谱面）"""
+        meta = {
             "name": "自定义关卡",
             "difficulty": self.difficulty,
-            "notes": [],
             "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
-        
-        for note in self.note_system.notes:
-            level_data["notes"].append({
-                "type": note['type'],
-                "time": note['time'],
-                "lane": note['lane'],
-                "duration": note['duration']
-            })
-        
-        # 保存到文件
         try:
-            with open("custom_level.json", "w") as f:
-                json.dump(level_data, f, indent=2)
+            ChartFile.save(path, self.note_system.notes, meta)
         except Exception as e:
             print(f"保存关卡错误: {e}")
     
+    def load_level(self, path=CUSTOM_LEVEL_FILE):
+        """加载自定义关卡，音符按需从文件读入"""
+        try:
+            chart = ChartFile.open(path)
+        except FileNotFoundError:
+            print(f"找不到关卡文件 {path}")
+            return False
+        except Exception as e:
+            print(f"加载关卡错误: {e}")
+            return False
+        self.note_system.load_chart(chart)
+        self.note_positions = None
+        print(f"已加载关卡: {chart.meta.get('name', path)} ({len(chart)} 个音符)")
+        return True
+    
+    def record_progress(self, record):
+        """写入进度日志（无显示运行的模拟对局不记录）"""
+        if not self.headless:
+            self.progress.append(record)
+    
+    def record_counters(self):
+        """把成就计数器写入进度日志（与已记录的值相同时跳过）"""
+        counters = dict(self.achievements.counters)
+        if counters != self.progress.state["counters"]:
+            self.record_progress({"type": "counters", "values": counters})
+    
     def save_progress(self):
-        """保存游戏进度"""
-        progress_data = {
-            "completed_songs": self.game_stats['completed_songs'],
-            "unlocked_achievements": len(self.achievements.unlocked),
-            "last_played": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "difficulty": self.difficulty,
-            "skin": self.skin
-        }
-        
+        """把进度日志合并为快照，等待写入完成"""
         try:
-            with open("game_progress.json", "w") as f:
-                json.dump(progress_data, f, indent=2)
+            self.record_counters()
+            self.progress.compact().result()
+            self.scores.wait()
             print("游戏进度已保存")
         except Exception as e:
             print(f"保存进度错误: {e}")
     
+    def completed_count(self):
+        """完成的歌曲数（不少于旧版进度文件记录的数量）"""
+        return max(len(self.completed_song_ids), self.progress.state["legacy_completed"])
+    
     def load_progress(self):
-        """加载游戏进度"""
+        """加载游戏进度（快照 + 日志）"""
         try:
-            if os.path.exists("game_progress.json"):
-                with open("game_progress.json", "r") as f:
-                    progress_data = json.load(f)
-                
-                self.game_stats['completed_songs'] = progress_data.get("completed_songs", 0)
-                self.difficulty = progress_data.get("difficulty", "中等")
-                self.skin = progress_data.get("skin", "default")
-                
-                # 加载成就解锁状态
-                unlocked_count = progress_data.get("unlocked_achievements", 0)
-                self.game_stats['unlocked_achievements'] = unlocked_count
-                
-                print(f"已加载进度: 完成歌曲 {self.game_stats['completed_songs']}/12")
+            progress_data = self.progress.load()
+            
+            self.completed_song_ids = set(progress_data["songs"])
+            self.game_stats['completed_songs'] = self.completed_count()
+            self.song_results = progress_data["songs"]
+            self.difficulty = progress_data["settings"].get("difficulty", "中等")
+            self.skin = progress_data["settings"].get("skin", "default")
+            
+            # 加载成就解锁状态
+            for achievement_id in progress_data["achievements"]:
+                self.achievements.unlock(achievement_id)
+            self.achievements.counters.update(progress_data["counters"])
+            self.game_stats['unlocked_achievements'] = len(self.achievements.unlocked)
+            
+            print(f"已加载进度: 完成歌曲 {self.game_stats['completed_songs']}/{len(self.music_library.songs)}")
         except Exception as e:
             print(f"加载进度错误: {e}")
 
+    def draw_loading(self):
+        """启动画面: 只用 pygame 自带的字体和简单图形，不等待系统字体扫描"""
+        if self.splash_font is None:
+            self.splash_font = pygame.font.Font(None, int(96 * self.renderer.scale_factor))
+        title_surf = self.splash_font.render("PyTonk", True, ACCENT)
+        title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 280)
+        self.screen.blit(title_surf, title_pos)
+        
+        # 来回移动的加载条
+        pygame.draw.rect(self.screen, PRIMARY, self.renderer.transform_rect((440, 400, 400, 12)), 2)
+        offset = abs((self.clock.get_ticks() // 4) % 600 - 300)
+        pygame.draw.rect(self.screen, HIGHLIGHT, self.renderer.transform_rect((440 + offset, 400, 100, 12)))
+    
     def draw_main_menu(self):
         """绘制主菜单"""
         # 绘制背景
-        scaled_bg = pygame.transform.scale(
-            self.background, 
-            (int(1280 * self.renderer.scale_factor), 
-            int(720 * self.renderer.scale_factor)
-        )
-        self.screen.blit(scaled_bg, (self.renderer.offset_x, self.renderer.offset_y))
+        self.screen.blit(self.get_scaled_background(), (self.renderer.offset_x, self.renderer.offset_y))
         
         # 绘制标题
-        title_surf = self.title_font.render(GAME_NAME, True, ACCENT)
+        title_surf = self.text_cache.render(self.title_font, GAME_NAME, True, ACCENT)
         title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 150)
         self.screen.blit(title_surf, title_pos)
         
         # 绘制版本号
-        version_surf = self.small_font.render(f"版本: {VERSION}", True, TEXT_COLOR)
+        version_surf = self.text_cache.render(self.small_font, f"版本: {VERSION}", True, TEXT_COLOR)
         version_pos = self.renderer.transform_pos(50, 680)
         self.screen.blit(version_surf, version_pos)
         
         # 绘制进度
-        progress_surf = self.small_font.render(f"完成歌曲: {self.game_stats['completed_songs']}/12", True, HIGHLIGHT)
+        progress_surf = self.text_cache.render(self.small_font, f"完成歌曲: {self.game_stats['completed_songs']}/{len(self.music_library.songs)}", True, HIGHLIGHT)
         progress_pos = self.renderer.transform_pos(640 - progress_surf.get_width()//2, 220)
         self.screen.blit(progress_surf, progress_pos)
         
@@ -975,7 +3541,7 @@ class PyTonkGame:
         self.screen.fill(BACKGROUND)
         
         # 绘制标题
-        title_surf = self.large_font.render("选择歌曲", True, PRIMARY)
+        title_surf = self.text_cache.render(self.large_font, "选择歌曲", True, PRIMARY)
         title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 50)
         self.screen.blit(title_surf, title_pos)
         
@@ -983,7 +3549,7 @@ class PyTonkGame:
         self.draw_button("back", "返回")
         
         # 难度选择
-        diff_title = self.medium_font.render("选择难度:", True, TEXT_COLOR)
+        diff_title = self.text_cache.render(self.medium_font, "选择难度:", True, TEXT_COLOR)
         self.screen.blit(diff_title, self.renderer.transform_pos(200, 550))
         
         self.draw_button("easy", "简单", (350, 540, 120, 40))
@@ -991,55 +3557,71 @@ class PyTonkGame:
         self.draw_button("hard", "困难", (650, 540, 120, 40))
         
         # 显示当前难度
-        diff_surf = self.small_font.render(f"当前难度: {self.difficulty}", True, HIGHLIGHT)
+        diff_surf = self.text_cache.render(self.small_font, f"当前难度: {self.difficulty}", True, HIGHLIGHT)
         self.screen.blit(diff_surf, self.renderer.transform_pos(500, 600))
         
-        # 显示歌曲列表
+        # 页码
+        self.draw_button("prev_page")
+        self.draw_button("next_page")
+        page_surf = self.text_cache.render(self.small_font, f"{self.song_page + 1}/{self.get_page_count()}", True, TEXT_COLOR)
+        self.screen.blit(page_surf, self.renderer.transform_pos(1010 - page_surf.get_width() // 2, 650))
+        
+        # 显示歌曲列表（当前页）
         y_pos = 120
-        for song in self.music_library.get_all_songs():
+        for slot, song in enumerate(self.get_page_songs()):
             # 检查歌曲是否已完成
-            is_completed = self.game_stats['completed_songs'] >= int(song['id'][4:])
+            is_completed = song['id'] in self.completed_song_ids
             song_color = HIGHLIGHT if is_completed else TEXT_COLOR
             
             song_text = f"{song['title']} - {song['artist']}"
-            song_surf = self.medium_font.render(song_text, True, song_color)
+            song_surf = self.text_cache.render(self.medium_font, song_text, True, song_color)
             self.screen.blit(song_surf, self.renderer.transform_pos(200, y_pos))
             
             # 添加选择按钮
-            btn_rect = (900, y_pos-10, 200, 40)
-            self.draw_button(f"song_{song['id']}", "选择", btn_rect)
+            self.draw_button(f"song_slot{slot}")
             
             # 显示歌曲时长
             duration_text = f"{song['duration']//60}:{song['duration']%60:02}"
-            duration_surf = self.small_font.render(duration_text, True, PRIMARY)
+            duration_surf = self.text_cache.render(self.small_font, duration_text, True, PRIMARY)
             self.screen.blit(duration_surf, self.renderer.transform_pos(1100, y_pos+5))
             
             # 显示难度
             diff_text = f"难度: {song['difficulty'][self.difficulty]}"
-            diff_surf = self.small_font.render(diff_text, True, ACCENT)
+            diff_surf = self.text_cache.render(self.small_font, diff_text, True, ACCENT)
             self.screen.blit(diff_surf, self.renderer.transform_pos(200, y_pos+40))
             
+            # 当前难度的个人最佳
+            best = self.scores.personal_best(song['id'], self.difficulty)
+            if best:
+                best_text = f"最佳: {best['score']} ({best['rank']})"
+                best_surf = self.text_cache.render(self.small_font, best_text, True, HIGHLIGHT)
+                self.screen.blit(best_surf, self.renderer.transform_pos(400, y_pos+40))
+            
             y_pos += 80
     
+    def draw_score_list(self, title, plays, y_pos):
+        """结果画面左侧的成绩列表，本局成绩高亮"""
+        title_surf = self.text_cache.render(self.medium_font, title, True, PRIMARY)
+        self.screen.blit(title_surf, self.renderer.transform_pos(60, y_pos))
+        y_pos += 40
+        for number, play in enumerate(plays, 1):
+            color = HIGHLIGHT if play['id'] == self.last_play_id else TEXT_COLOR
+            text = f"{number}. {play['score']}  {play['rank']}  {play['accuracy']*100:.1f}%"
+            play_surf = self.text_cache.render(self.small_font, text, True, color)
+            self.screen.blit(play_surf, self.renderer.transform_pos(60, y_pos))
+            y_pos += 32
+    
     def draw_playing(self):
         """绘制游戏画面"""
         # 绘制动态背景
-        scaled_bg = pygame.transform.scale(
-            self.background, 
-            (int(1280 * self.renderer.scale_factor), 
-            int(720 * self.renderer.scale_factor)
-        )
-        self.screen.blit(scaled_bg, (self.renderer.offset_x, self.renderer.offset_y))
+        self.screen.blit(self.get_scaled_background(), (self.renderer.offset_x, self.renderer.offset_y))
+        
+        # 渲染状态: 在最近两个模拟步之间插值
+        line_x, line_y, note_x, note_y, visible = self.interpolate_render_state()
         
         # 绘制判定线
-        line_start = self.renderer.transform_pos(
-            self.judgment_line.x - 500, 
-            self.judgment_line.y
-        )
-        line_end = self.renderer.transform_pos(
-            self.judgment_line.x + 500, 
-            self.judgment_line.y
-        )
+        line_start = self.renderer.transform_pos(line_x - 500, line_y)
+        line_end = self.renderer.transform_pos(line_x + 500, line_y)
         pygame.draw.line(
             self.screen, 
             (255, 255, 255), 
@@ -1048,47 +3630,19 @@ class PyTonkGame:
             int(self.renderer.transform_size(3))
         )
         
-        # 绘制音符
-        for note in self.note_system.notes:
-            if note['state'] == 'active':
-                x, y = self.calculate_note_position(note)
-                tx, ty = self.renderer.transform_pos(x, y)
-                note_type = note['type']
-                note_data = self.note_system.note_types[note_type]
-                radius = self.renderer.transform_size(note_data['size'])
-                
-                # 绘制音符
-                pygame.draw.circle(self.screen, note_data['color'], (tx, ty), radius)
-                
-                # 绘制音符类型指示
-                if note_type in ['hold', 'drag']:
-                    inner_radius = radius * 0.6
-                    pygame.draw.circle(self.screen, (255, 255, 255), (tx, ty), inner_radius, 2)
-                if note_type == 'flick':
-                    # 绘制箭头
-                    arrow_size = radius * 0.8
-                    pygame.draw.line(self.screen, (255, 255, 255), 
-                                   (tx - arrow_size, ty), 
-                                   (tx + arrow_size, ty), 2)
-                    pygame.draw.line(self.screen, (255, 255, 255), 
-                                   (tx + arrow_size - 10, ty - 10), 
-                                   (tx + arrow_size, ty), 2)
-                    pygame.draw.line(self.screen, (255, 255, 255), 
-                                   (tx + arrow_size - 10, ty + 10), 
-                                   (tx + arrow_size, ty), 2)
-                if note_type == 'special':
-                    # 绘制星形
-                    star_points = []
-                    for i in range(5):
-                        angle = math.pi/2 + i * 2*math.pi/5
-                        px = tx + radius * math.cos(angle)
-                        py = ty + radius * math.sin(angle)
-                        star_points.append((px, py))
-                        angle += math.pi/5
-                        px = tx + radius * 0.5 * math.cos(angle)
-                        py = ty + radius * 0.5 * math.sin(angle)
-                        star_points.append((px, py))
-                    pygame.draw.polygon(self.screen, (255, 255, 255), star_points, 2)
+        # 绘制音符（跳过已击中的音符）
+        note_codes = self.note_system.notes.type[visible]
+        
+        # 用预渲染的精灵整批绘制
+        atlas = self.note_atlas.get(self.note_system, self.skin, self.renderer.scale_factor)
+        half = atlas.half_sizes[note_codes]
+        blit_x = np.rint(note_x - half).astype(np.int32)
+        blit_y = np.rint(note_y - half).astype(np.int32)
+        sprites = atlas.sprites
+        self.screen.blits(
+            [(sprites[code], (bx, by)) for code, bx, by in zip(note_codes.tolist(), blit_x.tolist(), blit_y.tolist())],
+            doreturn=False
+        )
         
         # 绘制UI
         # 显示歌曲信息
@@ -1096,34 +3650,31 @@ class PyTonkGame:
             song = self.music_library.get_song_by_id(self.current_song_id)
             if song:
                 song_text = f"{song['title']} - {song['artist']}"
-                song_surf = self.medium_font.render(song_text, True, TEXT_COLOR)
+                song_surf = self.text_cache.render(self.medium_font, song_text, True, TEXT_COLOR)
                 self.screen.blit(song_surf, self.renderer.transform_pos(50, 50))
         
-        score_text = self.medium_font.render(f"分数: {self.game_stats['score']}", True, TEXT_COLOR)
-        combo_text = self.medium_font.render(f"连击: {self.game_stats['combo']}", True, TEXT_COLOR)
-        rank_text = self.large_font.render(f"评价: {self.game_stats['rank']}", True, HIGHLIGHT)
+        score_text = self.text_cache.render(self.medium_font, f"分数: {self.game_stats['score']}", True, TEXT_COLOR)
+        combo_text = self.text_cache.render(self.medium_font, f"连击: {self.game_stats['combo']}", True, TEXT_COLOR)
+        rank_text = self.text_cache.render(self.large_font, f"评价: {self.game_stats['rank']}", True, HIGHLIGHT)
         
         self.screen.blit(score_text, self.renderer.transform_pos(50, 100))
         self.screen.blit(combo_text, self.renderer.transform_pos(50, 150))
         self.screen.blit(rank_text, self.renderer.transform_pos(50, 200))
         
         # 进度条
-        progress_width = 1000 * self.renderer.scale_factor
-        progress_height = 10 * self.renderer.scale_factor
-        progress_x = self.renderer.offset_x + (self.screen.get_width() - progress_width) / 2
-        progress_y = self.renderer.offset_y + self.renderer.transform_size(650)
+        progress_x, progress_y, progress_width, progress_height = self.get_progress_bar_rect()
         
         # 背景条
         pygame.draw.rect(self.screen, (80, 80, 100), (progress_x, progress_y, progress_width, progress_height))
         
         # 进度填充
-        progress = min(1.0, (self.current_time - self.start_time) / self.song_duration)
+        progress = min(1.0, self.current_time / max(1, self.song_duration))
         fill_width = progress_width * progress
         pygame.draw.rect(self.screen, PRIMARY, (progress_x, progress_y, fill_width, progress_height))
         
         # 校准提示
         if self.show_calibration:
-            cal_surf = self.medium_font.render("校准中... 请按节拍点击!", True, HIGHLIGHT)
+            cal_surf = self.text_cache.render(self.medium_font, "校准中... 请按节拍点击!", True, HIGHLIGHT)
             cal_pos = self.renderer.transform_pos(640 - cal_surf.get_width()//2, 300)
             self.screen.blit(cal_surf, cal_pos)
             
@@ -1136,6 +3687,68 @@ class PyTonkGame:
                 indicator_size = 100 * (1.0 - time_left)
                 indicator_x, indicator_y = self.renderer.transform_pos(640, 400)
                 pygame.draw.circle(self.screen, ACCENT, (indicator_x, indicator_y), indicator_size, 5)
+        
+        # 游戏中解锁成就的提示
+        if self.achievement_toast is not None:
+            ach_id, unlock_time = self.achievement_toast
+            if self.clock.get_ticks() - unlock_time < ACHIEVEMENT_TOAST_MS:
+                ach = self.achievements.achievements[ach_id]
+                toast_surf = self.text_cache.render(self.small_font, f"解锁成就: {ach['icon']} {ach['name']}", True, HIGHLIGHT)
+                self.screen.blit(toast_surf, self.renderer.transform_pos(640 - toast_surf.get_width()//2, 60))
+            else:
+                self.achievement_toast = None
+    
+    def interpolate_render_state(self):
+        """按 render_alpha 在上一模拟步与当前模拟步之间插值
+        
+        返回判定线位置、可见音符的屏幕坐标和下标。判定仍使用模拟状态的位置。
+        """
+        line = self.judgment_line
+        positions = self.calculate_note_positions()
+        visible = self.note_system.notes.state[positions.indices] == STATE_ACTIVE
+        indices = positions.indices[visible]
+        behind = 1.0 - self.render_alpha
+        if self.game_state not in ("playing", "pause") or behind <= 0.0:
+            return line.x, line.y, positions.screen_x[visible], positions.screen_y[visible], indices
+        
+        prev_x, prev_y = self.previous_line
+        line_x = line.x + (prev_x - line.x) * behind
+        line_y = line.y + (prev_y - line.y) * behind
+        
+        # 进度随时间线性变化，回退 behind 个步长即为插值结果
+        step_seconds = 1.0 / SIM_RATE
+        progress = np.clip(self.note_system.notes.progress[indices] - behind * step_seconds, 0.0, 1.0)
+        x = line_x + (self.note_system.notes.lane[indices] * 100.0 - 350.0)
+        y = line_y - 200 + 200 * progress
+        screen_x, screen_y = self.renderer.transform_pos(x, y)
+        return line_x, line_y, screen_x, screen_y, indices
+    
+    def get_progress_bar_rect(self):
+        """歌曲进度条的屏幕区域"""
+        progress_width = 1000 * self.renderer.scale_factor
+        progress_height = 10 * self.renderer.scale_factor
+        progress_x = self.renderer.offset_x + (self.screen.get_width() - progress_width) / 2
+        progress_y = self.renderer.offset_y + self.renderer.transform_size(650)
+        return progress_x, progress_y, progress_width, progress_height
+    
+    def draw_replay(self):
+        """绘制回放画面"""
+        self.draw_playing()
+        player = self.replay_player
+        
+        # 返回按钮
+        self.draw_button("back", "返回")
+        
+        # 播放状态
+        position = int(player.position) // 1000
+        duration = player.duration // 1000
+        status = "已暂停" if player.paused else f"{player.speed:g}x"
+        status_text = f"回放 {status}  {position//60}:{position%60:02}/{duration//60}:{duration%60:02}"
+        status_surf = self.text_cache.render(self.medium_font, status_text, True, HIGHLIGHT)
+        self.screen.blit(status_surf, self.renderer.transform_pos(1230 - status_surf.get_width(), 50))
+        
+        help_surf = self.text_cache.render(self.tiny_font, "空格 暂停  ←/→ 跳转  ↑/↓ 速度  点击进度条跳转", True, TEXT_COLOR)
+        self.screen.blit(help_surf, self.renderer.transform_pos(1230 - help_surf.get_width(), 100))
     
     def draw_pause_menu(self):
         """绘制暂停菜单"""
@@ -1145,7 +3758,7 @@ class PyTonkGame:
         self.screen.blit(overlay, (0, 0))
         
         # 标题
-        title_surf = self.large_font.render("游戏暂停", True, PRIMARY)
+        title_surf = self.text_cache.render(self.large_font, "游戏暂停", True, PRIMARY)
         title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 200)
         self.screen.blit(title_surf, title_pos)
         
@@ -1159,7 +3772,7 @@ class PyTonkGame:
         self.screen.fill(BACKGROUND)
         
         # 标题
-        title_surf = self.large_font.render("游戏结果", True, PRIMARY)
+        title_surf = self.text_cache.render(self.large_font, "游戏结果", True, PRIMARY)
         title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 100)
         self.screen.blit(title_surf, title_pos)
         
@@ -1168,7 +3781,7 @@ class PyTonkGame:
             song = self.music_library.get_song_by_id(self.current_song_id)
             if song:
                 song_text = f"{song['title']} - {song['artist']}"
-                song_surf = self.medium_font.render(song_text, True, TEXT_COLOR)
+                song_surf = self.text_cache.render(self.medium_font, song_text, True, TEXT_COLOR)
                 self.screen.blit(song_surf, self.renderer.transform_pos(640 - song_surf.get_width()//2, 150))
         
         # 结果数据
@@ -1185,29 +3798,36 @@ class PyTonkGame:
         ]
         
         for result in results:
-            result_surf = self.medium_font.render(result, True, TEXT_COLOR)
+            result_surf = self.text_cache.render(self.medium_font, result, True, TEXT_COLOR)
             result_pos = self.renderer.transform_pos(640 - result_surf.get_width()//2, y_pos)
             self.screen.blit(result_surf, result_pos)
             y_pos += 40
         
+        # 排行榜和最近游玩
+        if self.current_song_id:
+            self.draw_score_list("排行榜", self.scores.leaderboard(self.current_song_id, self.difficulty), 200)
+            self.draw_score_list("最近游玩", self.scores.history(self.current_song_id, self.difficulty, 3), 420)
+        
         # 绘制按钮
         self.draw_button("restart", "再玩一次", (440, 550, 200, 60))
         self.draw_button("menu", "主菜单", (640, 550, 200, 60))
+        if self.replay_data:
+            self.draw_button("replay", "观看回放")
         
         # 显示新解锁的成就
-        if self.achievements.unlocked:
+        if self.session_unlocks:
             y_pos = 500
-            unlock_surf = self.medium_font.render("解锁成就:", True, HIGHLIGHT)
+            unlock_surf = self.text_cache.render(self.medium_font, "解锁成就:", True, HIGHLIGHT)
             self.screen.blit(unlock_surf, self.renderer.transform_pos(640 - unlock_surf.get_width()//2, y_pos))
             y_pos += 40
             
-            for ach_id in self.achievements.unlocked[:3]:  # 最多显示3个
+            for ach_id in self.session_unlocks[:3]:  # 最多显示3个
                 ach = self.achievements.achievements[ach_id]
-                ach_surf = self.medium_font.render(f"{ach['icon']} {ach['name']}", True, HIGHLIGHT)
+                ach_surf = self.text_cache.render(self.medium_font, f"{ach['icon']} {ach['name']}", True, HIGHLIGHT)
                 self.screen.blit(ach_surf, self.renderer.transform_pos(640 - ach_surf.get_width()//2, y_pos))
                 y_pos += 30
                 
-                desc_surf = self.small_font.render(ach['desc'], True, ACCENT)
+                desc_surf = self.text_cache.render(self.small_font, ach['desc'], True, ACCENT)
                 self.screen.blit(desc_surf, self.renderer.transform_pos(640 - desc_surf.get_width()//2, y_pos))
                 y_pos += 40
     
@@ -1216,7 +3836,7 @@ class PyTonkGame:
         self.screen.fill(BACKGROUND)
         
         # 标题
-        title_surf = self.large_font.render("成就系统", True, PRIMARY)
+        title_surf = self.text_cache.render(self.large_font, "成就系统", True, PRIMARY)
         title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 50)
         self.screen.blit(title_surf, title_pos)
         
@@ -1226,14 +3846,14 @@ class PyTonkGame:
         # 成就统计
         unlocked = sum(1 for a in self.achievements.achievements.values() if a['achieved'])
         total = len(self.achievements.achievements)
-        stats_surf = self.medium_font.render(f"已解锁: {unlocked}/{total}", True, HIGHLIGHT)
+        stats_surf = self.text_cache.render(self.medium_font, f"已解锁: {unlocked}/{total}", True, HIGHLIGHT)
         self.screen.blit(stats_surf, self.renderer.transform_pos(640 - stats_surf.get_width()//2, 120))
         
         # 显示成就
         y_pos = 180
         for ach_id, ach in self.achievements.achievements.items():
             color = HIGHLIGHT if ach['achieved'] else (100, 100, 100)
-            ach_surf = self.medium_font.render(f"{ach['icon']} {ach['name']}: {ach['desc']}", True, color)
+            ach_surf = self.text_cache.render(self.medium_font, f"{ach['icon']} {ach['name']}: {ach['desc']}", True, color)
             self.screen.blit(ach_surf, self.renderer.transform_pos(200, y_pos))
             y_pos += 60
     
@@ -1242,7 +3862,7 @@ class PyTonkGame:
         self.screen.fill(BACKGROUND)
         
         # 标题
-        title_surf = self.large_font.render("游戏设置", True, PRIMARY)
+        title_surf = self.text_cache.render(self.large_font, "游戏设置", True, PRIMARY)
         title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 100)
         self.screen.blit(title_surf, title_pos)
         
@@ -1253,7 +3873,7 @@ class PyTonkGame:
         self.draw_button("calibrate", "立即校准")
         
         # 皮肤选择
-        skin_title = self.medium_font.render("选择主题:", True, TEXT_COLOR)
+        skin_title = self.text_cache.render(self.medium_font, "选择主题:", True, TEXT_COLOR)
         self.screen.blit(skin_title, self.renderer.transform_pos(200, 300))
         
         self.draw_button("skin1", "默认")
@@ -1269,7 +3889,7 @@ class PyTonkGame:
         ]
         
         for setting in settings:
-            setting_surf = self.medium_font.render(setting, True, TEXT_COLOR)
+            setting_surf = self.text_cache.render(self.medium_font, setting, True, TEXT_COLOR)
             self.screen.blit(setting_surf, self.renderer.transform_pos(200, setting_y))
             setting_y += 50
     
@@ -1278,7 +3898,7 @@ class PyTonkGame:
         self.screen.fill(BACKGROUND)
         
         # 标题
-        title_surf = self.large_font.render("关卡编辑器", True, PRIMARY)
+        title_surf = self.text_cache.render(self.large_font, "关卡编辑器", True, PRIMARY)
         title_pos = self.renderer.transform_pos(640 - title_surf.get_width()//2, 50)
         self.screen.blit(title_surf, title_pos)
         
@@ -1287,12 +3907,13 @@ class PyTonkGame:
         
         # 保存按钮
         self.draw_button("save", "保存关卡")
+        self.draw_button("load", "加载关卡")
         
         # 添加音符按钮
         self.draw_button("add_note", "添加音符")
         
         # 音符类型选择
-        note_title = self.medium_font.render("音符类型:", True, TEXT_COLOR)
+        note_title = self.text_cache.render(self.medium_font, "音符类型:", True, TEXT_COLOR)
         self.screen.blit(note_title, self.renderer.transform_pos(1000, 150))
         
         for note_type in self.note_system.note_types:
@@ -1300,17 +3921,17 @@ class PyTonkGame:
             self.draw_button(btn_id, note_type.capitalize())
         
         # 当前选择
-        selected_surf = self.small_font.render(f"当前选择: {self.selected_note_type}", True, HIGHLIGHT)
+        selected_surf = self.text_cache.render(self.small_font, f"当前选择: {self.selected_note_type}", True, HIGHLIGHT)
         self.screen.blit(selected_surf, self.renderer.transform_pos(1000, 450))
         
         # 绘制游戏视图
         self.draw_playing()
         
         # 编辑器信息
-        time_surf = self.small_font.render(f"时间: {self.editor_time/1000:.1f}秒", True, TEXT_COLOR)
+        time_surf = self.text_cache.render(self.small_font, f"时间: {self.editor_time/1000:.1f}秒", True, TEXT_COLOR)
         self.screen.blit(time_surf, self.renderer.transform_pos(50, 150))
         
-        count_surf = self.small_font.render(f"音符数量: {len(self.note_system.notes)}", True, TEXT_COLOR)
+        count_surf = self.text_cache.render(self.small_font, f"音符数量: {len(self.note_system.notes)}", True, TEXT_COLOR)
         self.screen.blit(count_surf, self.renderer.transform_pos(50, 180))
     
     def draw_button(self, button_id, text=None, custom_rect=None):
@@ -1334,11 +3955,77 @@ class PyTonkGame:
         
         # 绘制按钮文本
         if text:
-            btn_text = self.medium_font.render(text, True, TEXT_COLOR)
+            btn_text = self.text_cache.render(self.medium_font, text, True, TEXT_COLOR)
             text_x = btn_rect.x + (btn_rect.width - btn_text.get_width()) // 2
             text_y = btn_rect.y + (btn_rect.height - btn_text.get_height()) // 2
             self.screen.blit(btn_text, (text_x, text_y))
     
+    def invalidate(self, rect=None):
+        """标记需要重绘的区域（基准分辨率坐标），不传参数则整屏重绘"""
+        if rect is None:
+            self.scene_key = None
+        else:
+            self.dirty_rects.append(pygame.Rect(self.renderer.transform_rect(rect)))
+    
+    def get_scene_key(self):
+        """静态界面的标识，变化时需要整屏重新合成"""
+        return (self.game_state, self.renderer.scale_factor, self.screen.get_size())
+    
+    def is_scene_idle(self):
+        """当前静态界面已合成且没有失效区域"""
+        return (self.game_state in STATIC_SCREENS and not self.dirty_rects
+                and self.scene_key == self.get_scene_key() and not self.profiler.enabled
+                and not self.audio_loader.is_busy())
+    
+    def draw_screen(self):
+        """绘制当前状态的完整画面"""
+        self.screen.fill(BACKGROUND)
+        
+        if self.game_state == "loading":
+            self.draw_loading()
+        elif self.game_state == "main_menu":
+            self.draw_main_menu()
+        elif self.game_state == "song_select":
+            self.draw_song_select()
+        elif self.game_state == "playing":
+            self.draw_playing()
+        elif self.game_state == "pause":
+            self.draw_playing()
+            self.draw_pause_menu()
+        elif self.game_state == "results":
+            self.draw_results()
+        elif self.game_state == "achievements":
+            self.draw_achievements()
+        elif self.game_state == "settings":
+            self.draw_settings()
+        elif self.game_state == "editor":
+            self.draw_editor()
+        elif self.game_state == "replay":
+            self.draw_replay()
+        
+        if self.profiler.enabled:
+            self.profiler.draw(self.screen, self.renderer, self.tiny_font)
+    
+    def draw_static_screen(self):
+        """保留模式: 界面切换时整屏合成，之后只重绘失效区域
+        
+        返回需要提交到显示的区域: None 表示整屏，空列表表示无需更新
+        """
+        key = self.get_scene_key()
+        update_rects = []
+        if key != self.scene_key:
+            self.draw_screen()
+            update_rects = None
+            self.scene_key = key
+        elif self.dirty_rects:
+            # 限制绘制范围，只有失效区域的像素会被改写
+            self.screen.set_clip(self.dirty_rects[0].unionall(self.dirty_rects[1:]))
+            self.draw_screen()
+            self.screen.set_clip(None)
+            update_rects = self.dirty_rects
+        self.dirty_rects = []
+        return update_rects
+    
     def run(self):
         """运行游戏主循环"""
         # 创建窗口 - 使用固定尺寸以适应Pydroid 3
@@ -1348,62 +4035,157 @@ class PyTonkGame:
         # 更新渲染器
         self.renderer.update(self.screen)
         
-        # 初始绘制
-        self.screen.fill(BACKGROUND)
-        self.draw_main_menu()
+        # 渲染帧率跟随显示器刷新率，模拟频率固定为 SIM_RATE
+        self.fps = self.get_refresh_rate()
+        self.profiler.target_ms = 1000.0 / self.fps
+        
+        # 先显示启动画面，字体和背景在后台线程中加载
+        self.resources.start_preload()
+        self.game_state = "loading"
+        self.draw_screen()
         pygame.display.flip()
+        print(f"首帧: {(time.perf_counter() - STARTUP_TIME) * 1000:.0f} 毫秒")
         
         running = True
         while running:
-            for event in pygame.event.get():
-                if event.type == QUIT:
-                    self.save_progress()
-                    running = False
-                elif event.type == KEYDOWN:
-                    if event.key == K_ESCAPE:
-                        if self.game_state == "playing":
-                            self.game_state = "pause"
-                        elif self.game_state == "pause":
-                            self.game_state = "playing"
-                        else:
-                            self.game_state = "main_menu"
-                # 处理鼠标/触摸事件
-                self.handle_input(event)
-            
-            # 更新游戏状态
-            self.update()
-            
-            # 绘制当前屏幕
-            self.screen.fill(BACKGROUND)
-            
-            if self.game_state == "main_menu":
-                self.draw_main_menu()
-            elif self.game_state == "song_select":
-                self.draw_song_select()
-            elif self.game_state == "playing":
-                self.draw_playing()
-            elif self.game_state == "pause":
-                self.draw_playing()
-                self.draw_pause_menu()
-            elif self.game_state == "results":
-                self.draw_results()
-            elif self.game_state == "achievements":
-                self.draw_achievements()
-            elif self.game_state == "settings":
-                self.draw_settings()
-            elif self.game_state == "editor":
-                self.draw_editor()
-            
-            # 更新显示
-            pygame.display.flip()
-            
-            # 控制帧率
-            self.clock.tick(60)
-        
+            running = self.run_frame()
+        self.shutdown()
+    
+    def shutdown(self):
+        """退出游戏（关闭窗口和"退出游戏"按钮共用）: 保存进度和帧时间统计后结束进程"""
+        self.save_progress()
+        if self.profiler.frames:
+            self.profiler.export()
+        self.audio_loader.shutdown()
         pygame.quit()
         sys.exit()
+    
+    def get_refresh_rate(self):
+        """显示器刷新率，旧版 pygame 或无法获取时使用 DEFAULT_FPS"""
+        get_rate = getattr(pygame.display, "get_current_refresh_rate", None)
+        try:
+            rate = get_rate() if get_rate else 0
+        except pygame.error:
+            rate = 0
+        return rate if rate > 0 else DEFAULT_FPS
+    
+    def run_frame(self, draw=True):
+        """处理事件、更新并绘制一帧，返回是否继续运行"""
+        running = True
+        profiler = self.profiler
+        profiler.begin_frame()
+        events = pygame.event.get()
+        if not events and not self.headless and self.is_scene_idle():
+            # 静态界面没有变化时阻塞等待输入，不占用 CPU
+            event = pygame.event.wait(IDLE_WAIT_MS)
+            events = [event] if event.type != NOEVENT else []
+        events = self.input_times.collect(events)
+        
+        for event in events:
+            if event.type == QUIT:
+                running = False
+            elif event.type == KEYDOWN:
+                # ESC 由 handle_input 处理，这里再切换一次会把暂停立即取消
+                if event.key == K_F3:
+                    profiler.toggle()
+                    self.invalidate()
+            elif event.type in (VIDEOEXPOSE, WINDOWEXPOSED):
+                self.invalidate()
+            # 处理鼠标/触摸事件
+            self.handle_input(event)
+        profiler.mark(FrameProfiler.EVENTS)
+        
+        # 更新游戏状态
+        self.update()
+        profiler.mark(FrameProfiler.UPDATE)
+        
+        # 绘制当前屏幕
+        if draw:
+            if self.game_state in STATIC_SCREENS:
+                if profiler.enabled:
+                    self.invalidate(FrameProfiler.OVERLAY_RECT)
+                update_rects = self.draw_static_screen()
+                profiler.mark(FrameProfiler.DRAW)
+                if update_rects is None:
+                    pygame.display.flip()
+                elif update_rects:
+                    pygame.display.update(update_rects)
+            else:
+                self.draw_screen()
+                profiler.mark(FrameProfiler.DRAW)
+                pygame.display.flip()
+                self.scene_key = None
+            profiler.mark(FrameProfiler.FLIP)
+        
+        # 控制帧率（虚拟时钟只前进时间，不等待）；游戏中等待时轮询点击，记下发生时刻
+        poll = self.input_times.poll if self.game_state == "playing" else None
+        self.clock.tick(self.fps, poll)
+        return running
+    
+    def run_headless(self, song_id, input_source=None, draw=False):
+        """无显示加速运行一局，返回本局统计"""
+        self.screen = pygame.display.set_mode((1280, 720))
+        self.renderer.update(self.screen)
+        self.input_source = input_source
+        
+        wall_start = time.perf_counter()
+        self.start_game(song_id)
+        frames = 0
+        while self.game_state == "playing":
+            self.run_frame(draw)
+            frames += 1
+        wall_time = time.perf_counter() - wall_start
+        if self.profiler.frames:
+            self.profiler.export()
+        
+        song_time = self.current_time / 1000
+        print(f"模拟完成: {frames} 帧, 歌曲时间 {song_time:.1f} 秒, 实际用时 {wall_time:.2f} 秒 "
+              f"({song_time / max(wall_time, 1e-6):.0f}x)")
+        return self.game_stats
 
 # 启动游戏
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=GAME_NAME)
+    parser.add_argument("--headless", action="store_true", help="无显示加速运行一局")
+    parser.add_argument("--song", default=None, help="歌曲 ID，例如 song1")
+    parser.add_argument("--difficulty", default="中等", choices=["简单", "中等", "困难"], help="难度")
+    parser.add_argument("--autoplay", action="store_true", help="自动演奏")
+    parser.add_argument("--script", default=None, help="输入脚本 JSON 文件")
+    parser.add_argument("--fps", type=int, default=60, help=f"渲染帧率（游戏逻辑始终以 {SIM_RATE} Hz 模拟）")
+    parser.add_argument("--draw", action="store_true", help="无显示模式下仍执行绘制")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="谱面种子（代替按歌曲和难度得到的固定种子），未指定 --song 时也决定选中的歌曲")
+    parser.add_argument("--profile", action="store_true", help="开启帧时间统计（游戏中按 F3 切换）")
+    args = parser.parse_args(argv)
+    # 种子写入回放文件头（32 位无符号整数）
+    if args.seed is not None and not 0 <= args.seed < 2 ** 32:
+        parser.error("--seed 必须在 0 到 4294967295 之间")
+    return args
+
 if __name__ == "__main__":
-    game = PyTonkGame()
-    game.run()
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    init_pygame(headless=args.headless)
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.headless:
+        game = PyTonkGame(clock=VirtualClock(), headless=True)
+        game.difficulty = args.difficulty
+        game.seed_override = args.seed
+        game.fps = args.fps
+        game.profiler = FrameProfiler(args.fps)
+        game.profiler.enabled = args.profile
+        if args.script:
+            input_source = ScriptedInput.load(args.script)
+        elif args.autoplay:
+            input_source = AutoPlayInput()
+        else:
+            input_source = None
+        stats = game.run_headless(args.song, input_source, draw=args.draw)
+        print(json.dumps({key: stats[key] for key in ('score', 'max_combo', 'hits', 'misses', 'accuracy', 'rank')},
+                         ensure_ascii=False))
+        pygame.quit()
+    else:
+        game = PyTonkGame()
+        game.seed_override = args.seed
+        game.profiler.enabled = args.profile
+        game.run()
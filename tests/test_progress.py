@@ -0,0 +1,54 @@
+"""进度文件兼容性测试（python -m unittest discover tests）"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import main
+
+
+class ProgressJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.snapshot = os.path.join(self.directory.name, main.PROGRESS_FILE)
+        self.journal_path = os.path.join(self.directory.name, main.PROGRESS_JOURNAL_FILE)
+    
+    def tearDown(self):
+        self.directory.cleanup()
+    
+    def open_journal(self):
+        journal = main.ProgressJournal(self.snapshot, self.journal_path)
+        self.addCleanup(journal.close)
+        return journal
+    
+    def test_baseline_progress_file(self):
+        # 最早版本的 save_progress 只写入完成歌曲数，没有歌曲 ID
+        with open(self.snapshot, "w") as f:
+            json.dump({"completed_songs": 3, "unlocked_achievements": 1,
+                       "last_played": "2025-07-19 12:00:00", "difficulty": "困难", "skin": "neon"}, f, indent=2)
+        
+        journal = self.open_journal()
+        state = journal.load()
+        self.assertEqual(state["legacy_completed"], 3)
+        self.assertEqual(state["settings"], {"difficulty": "困难", "skin": "neon"})
+        self.assertEqual(state["last_played"], "2025-07-19 12:00:00")
+        
+        # 转换后的快照保留旧的完成数
+        journal.compact().result()
+        self.assertEqual(self.open_journal().load()["legacy_completed"], 3)
+    
+    def test_completed_song_ids(self):
+        with open(self.snapshot, "w") as f:
+            json.dump({"completed_songs": 2, "completed_song_ids": ["song1", "song2"]}, f)
+        state = self.open_journal().load()
+        self.assertEqual(set(state["songs"]), {"song1", "song2"})
+        self.assertEqual(state["legacy_completed"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()